@@ -0,0 +1,275 @@
+# Copyright (C) 2017 Les Fees Speciales
+# voeu@les-fees-speciales.coop
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Run proxify, deproxify or bake on many .blend files, without the UI.
+
+Usage:
+
+    blender --background --python batch.py -- proxify shot_010.blend shot_020.blend
+    blender --background --python batch.py -- bake --manifest shots.txt --jobs 4 --summary summary.json
+
+It can also be run with a plain Python interpreter, giving the Blender
+executable with --blender. Each file is processed by its own background
+Blender process, and saved back only if the operation succeeded, by
+replacing it with a complete copy.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import concurrent.futures
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+OPERATIONS = ('proxify', 'deproxify', 'bake')
+
+# Add-ons a bake needs, disabled by --factory-startup: the pantin importer
+# registers the imported_items giving baked textures their pantin names.
+BAKE_ADDONS = ('import_pantin_from_lib',)
+
+
+def read_manifest(path):
+    """Return the .blend files listed in a manifest.
+
+    A manifest is either a JSON list of paths, or a text file with one path
+    per line. Relative paths are relative to the manifest.
+    """
+    with open(path) as f:
+        content = f.read()
+    if path.endswith('.json'):
+        files = json.loads(content)
+    else:
+        files = [line.strip() for line in content.splitlines()
+                 if line.strip() and not line.startswith('#')]
+    directory = os.path.dirname(os.path.abspath(path))
+    return [os.path.join(directory, f) for f in files]
+
+
+def run_file(blender, operation, filepath, options, timeout=None):
+    """Process one .blend file in a background Blender process.
+
+    Return a summary dict of the run.
+    """
+    fd, result_file = tempfile.mkstemp(prefix="batch_", suffix=".json")
+    os.close(fd)
+    command = [blender, '--background', '--factory-startup', filepath,
+               '--python', os.path.abspath(__file__),
+               '--', 'worker', operation, result_file] + options
+    start = time.time()
+    result = {"file": filepath, "operation": operation, "ok": False}
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, timeout=timeout)
+        with open(result_file) as f:
+            result.update(json.load(f))
+        if process.returncode != 0 and result["ok"]:
+            result["ok"] = False
+            result["error"] = "Blender exited with code %d" % process.returncode
+    except subprocess.TimeoutExpired:
+        result["error"] = "Timed out after %d s" % timeout
+    except (OSError, ValueError) as e:
+        result["error"] = "Worker did not report: %s" % e
+    finally:
+        os.remove(result_file)
+    result["seconds"] = time.time() - start
+    return result
+
+
+def run(blender, operation, files, jobs=1, options=(), timeout=None):
+    """Process .blend files with jobs Blender processes at a time.
+
+    Return the summary of the whole run.
+    """
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(run_file, blender, operation,
+                                   os.path.abspath(f), list(options), timeout)
+                   for f in files]
+        results = []
+        for future in futures:
+            result = future.result()
+            print("Batch: %s %s in %.1f s%s" % (
+                "done" if result["ok"] else "FAILED", result["file"],
+                result["seconds"],
+                "" if result["ok"] else ": " + result.get("error", "")))
+            results.append(result)
+    return {
+        "operation": operation,
+        "seconds": time.time() - start,
+        "files": results,
+        "failed": [result["file"] for result in results if not result["ok"]],
+    }
+
+
+class Reporter:
+    """Stand-in for an operator's report() in background functions"""
+
+    def __init__(self):
+        self.messages = []
+
+    def report(self, type, message):
+        print("%s: %s" % ("/".join(sorted(type)), message))
+        self.messages.append(message)
+
+
+def save_atomically():
+    """Save the open file over itself, replacing it only once fully written"""
+    filepath = bpy.data.filepath
+    directory, filename = os.path.split(filepath)
+    fd, partial = tempfile.mkstemp(prefix=filename + ".", suffix=".blend",
+                                   dir=directory)
+    os.close(fd)
+    try:
+        bpy.ops.wm.save_as_mainfile(filepath=partial, copy=True)
+        os.replace(partial, filepath)
+    except Exception:
+        if os.path.isfile(partial):
+            os.remove(partial)
+        raise
+
+
+def worker(operation, result_file, args):
+    """Run an operation on the open file (inside a worker Blender process)"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import proxify
+    import material_tuning
+
+    result = {"ok": False}
+    start = time.time()
+    try:
+        scene = bpy.context.scene
+        reporter = Reporter()
+        if operation in ('proxify', 'deproxify'):
+            proxify.register()
+            if args.proxy_workers is not None:
+                scene.proxy_workers = args.proxy_workers
+            report = proxify.StageReport(operation)
+        if operation == 'proxify' and args.budget is not None:
+            plan, used = proxify.plan_memory_budget(bpy.context, args.budget * 1024 * 1024)
+            failed_images = []
+            for progress in proxify.iter_apply_proxy_plan(plan, failed_images, report):
+                if progress is None:
+                    time.sleep(0.1)
+            result["failed_images"] = [img.name for img in failed_images]
+            result["estimated_memory"] = used
+        elif operation == 'proxify':
+            if args.width is not None:
+                scene.proxy_destination = args.width
+            failed_images = proxify.proxify_images(list(bpy.data.images), report)
+            result["failed_images"] = [img.name for img in failed_images]
+        elif operation == 'deproxify':
+            images = proxify.images_to_deproxify(
+                proxify.proxy_registry.proxies()
+                + proxify.proxy_registry.orphans())
+            for progress in proxify.iter_deproxify_images(images, report):
+                if progress is None:
+                    time.sleep(0.1)
+        elif operation == 'bake':
+            import addon_utils
+            for module in BAKE_ADDONS:
+                if addon_utils.enable(module, default_set=False) is None:
+                    reporter.report({"WARNING"}, "Could not enable add-on %s" % module)
+            material_tuning.register()
+            report = material_tuning.BakeReport(operation)
+            material_tuning.bake_all_textures(reporter, report, args.force)
+        report.finish()
+        result["report"] = report.as_dict()
+        result["warnings"] = reporter.messages
+        result["process_seconds"] = time.time() - start
+        save_atomically()
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["total_seconds"] = time.time() - start
+    with open(result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="batch.py")
+    subparsers = parser.add_subparsers(dest='command')
+    for operation in OPERATIONS:
+        sub = subparsers.add_parser(operation)
+        sub.add_argument('files', nargs='*', help=".blend files")
+        sub.add_argument('--manifest', help="File listing .blend files")
+        sub.add_argument('--jobs', type=int, default=1,
+                         help="Number of files processed at the same time")
+        sub.add_argument('--blender', default=bpy.app.binary_path if bpy else 'blender',
+                         help="Blender executable")
+        sub.add_argument('--summary', help="Write a JSON summary to this file")
+        sub.add_argument('--timeout', type=float, help="Seconds allowed per file")
+        sub.add_argument('--width', type=int, help="Proxy destination width")
+        sub.add_argument('--budget', type=int,
+                         help="Proxify to fit the images in this many MB instead")
+        sub.add_argument('--proxy-workers', type=int,
+                         help="Processes resizing images in each file")
+        sub.add_argument('--force', action='store_true',
+                         help="Bake textures even if they are up to date")
+    worker_parser = subparsers.add_parser('worker')
+    worker_parser.add_argument('operation', choices=OPERATIONS)
+    worker_parser.add_argument('result_file')
+    worker_parser.add_argument('--width', type=int)
+    worker_parser.add_argument('--budget', type=int)
+    worker_parser.add_argument('--proxy-workers', type=int)
+    worker_parser.add_argument('--force', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        worker(args.operation, args.result_file, args)
+        return 0
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    files = list(args.files)
+    if args.manifest:
+        files += read_manifest(args.manifest)
+    options = []
+    if args.width is not None:
+        options += ['--width', str(args.width)]
+    if args.budget is not None:
+        options += ['--budget', str(args.budget)]
+    if args.proxy_workers is not None:
+        options += ['--proxy-workers', str(args.proxy_workers)]
+    if args.force:
+        options += ['--force']
+
+    summary = run(args.blender, args.command, files, args.jobs, options,
+                  args.timeout)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    print("Batch: %d files in %.1f s, %d failed" % (
+        len(files), summary["seconds"], len(summary["failed"])))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    if "--" in sys.argv:
+        argv = sys.argv[sys.argv.index("--") + 1:]
+    elif bpy is None:
+        argv = sys.argv[1:]
+    else:  # arguments are Blender's own
+        argv = []
+    sys.exit(main(argv))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017 Les Fees Speciales
+# voeu@les-fees-speciales.coop
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Stand-in for the Blender executable, used as bpy.app.binary_path.
+
+Runs the script given with --python with the fake bpy module, so that
+the proxy worker processes can run without Blender:
+
+    fake_blender.py --background --factory-startup --python proxify.py -- worker jobs.json
+"""
+
+import os
+import sys
+import runpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_bpy
+
+
+def main():
+    args = sys.argv[1:]
+    if "--" in args:
+        args = args[:args.index("--")]
+    if "--python" not in args:
+        return 0
+    script = args[args.index("--python") + 1]
+    fake_bpy.install()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    runpy.run_path(script, run_name="__main__")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,799 @@
+# Copyright (C) 2017 Les Fees Speciales
+# voeu@les-fees-speciales.coop
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Minimal stand-in for Blender's bpy module, for benchmarks.
+
+Only the parts of the API used by proxify.py and material_tuning.py are
+provided, with enough behaviour for their code paths to run: datablock
+collections, ID properties, images with pixels read from and written to
+PNG files, Blender Internal style node trees and curve mappings.
+Call install() before importing the add-ons.
+"""
+
+import os
+import sys
+from types import SimpleNamespace, ModuleType
+import zlib
+import struct
+
+import numpy as np
+
+
+# Properties
+
+class _Property:
+    """Data descriptor standing for a bpy.props property"""
+
+    def __init__(self, default=None, update=None, **kwargs):
+        self.default = default
+        self.update = update
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.__dict__.get(self.name, self.default)
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+        if self.update is not None:
+            self.update(instance, context)
+
+
+class _PointerProperty(_Property):
+    """Data descriptor standing for a PointerProperty to a PropertyGroup"""
+
+    def __init__(self, type, **kwargs):
+        super().__init__(**kwargs)
+        self.type = type
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.name not in instance.__dict__:
+            instance.__dict__[self.name] = self.type()
+        return instance.__dict__[self.name]
+
+
+def _property_factory(default):
+    def factory(**kwargs):
+        kwargs.setdefault('default', default)
+        return _Property(**kwargs)
+    return factory
+
+
+class _Types(type):
+    """Metaclass naming properties assigned to classes after creation"""
+
+    def __setattr__(cls, name, value):
+        if isinstance(value, _Property):
+            value.name = name
+        super().__setattr__(name, value)
+
+
+props = SimpleNamespace(
+    IntProperty=_property_factory(0),
+    FloatProperty=_property_factory(0.0),
+    BoolProperty=_property_factory(False),
+    StringProperty=_property_factory(""),
+    EnumProperty=_property_factory(""),
+    FloatVectorProperty=_property_factory((0.0, 0.0, 0.0)),
+    PointerProperty=_PointerProperty,
+)
+
+
+# Datablocks
+
+class ID(metaclass=_Types):
+    """Datablock with a name and ID properties"""
+
+    def __init__(self, name):
+        self._name = name
+        self._collection = None
+        self._props = {}
+        self.library = None
+        self.use_fake_user = False
+        self.users = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        if self._collection is not None:
+            self._collection._rename(self, value)
+        else:
+            self._name = value
+
+    def __getitem__(self, key):
+        return self._props[key]
+
+    def __setitem__(self, key, value):
+        self._props[key] = value
+
+    def __delitem__(self, key):
+        del self._props[key]
+
+    def __contains__(self, key):
+        return key in self._props
+
+    def get(self, key, default=None):
+        return self._props.get(key, default)
+
+    def as_pointer(self):
+        return id(self)
+
+    def update_tag(self):
+        pass
+
+    def user_clear(self):
+        self.users = 0
+
+    def __repr__(self):
+        return "<%s %r>" % (type(self).__name__, self._name)
+
+
+class IDCollection:
+    """bpy.data collection of datablocks, by unique name"""
+
+    def __init__(self, factory=None):
+        self._items = {}
+        self._factory = factory
+        self.is_updated = False
+
+    def link(self, item):
+        name = item._name
+        index = 1
+        while name in self._items:
+            name = "%s.%03d" % (item._name, index)
+            index += 1
+        item._name = name
+        item._collection = self
+        self._items[name] = item
+        return item
+
+    def _rename(self, item, name):
+        del self._items[item._name]
+        item._name = name
+        self.link(item)
+
+    def new(self, name, *args, **kwargs):
+        return self.link(self._factory(name, *args, **kwargs))
+
+    def remove(self, item):
+        del self._items[item._name]
+        item._collection = None
+
+    def get(self, name, default=None):
+        return self._items.get(name, default)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self._items.values())[key]
+        return self._items[key]
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __iter__(self):
+        return iter(list(self._items.values()))
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        self._items.clear()
+
+
+# Images
+
+def _paeth(left, up, up_left):
+    distance_left = np.abs(up - up_left)
+    distance_up = np.abs(left - up_left)
+    distance_up_left = np.abs(left + up - 2 * up_left)
+    return np.where((distance_left <= distance_up) & (distance_left <= distance_up_left),
+                    left, np.where(distance_up <= distance_up_left, up, up_left))
+
+
+def _predictors(filter_types, left, up, up_left):
+    return np.choose(filter_types, (0, left, up, (left + up) >> 1,
+                                    _paeth(left, up, up_left)))
+
+
+def _filter_rows(rows, filter_types):
+    """Apply PNG filters to (height, width, 4) 8 bit scanlines"""
+    pixels = rows.astype(np.int16)
+    left = np.zeros_like(pixels)
+    left[:, 1:] = pixels[:, :-1]
+    up = np.zeros_like(pixels)
+    up[1:] = pixels[:-1]
+    up_left = np.zeros_like(pixels)
+    up_left[1:, 1:] = pixels[:-1, :-1]
+    predictors = _predictors(filter_types[:, None, None], left, up, up_left)
+    return ((pixels - predictors) & 0xff).astype(np.uint8)
+
+
+def _unfilter_rows(rows, filter_types):
+    """Undo the PNG filters of (height, width, 4) 8 bit scanlines.
+
+    Pixels only depend on the ones left and above them, so they are
+    decoded one anti-diagonal at a time.
+    """
+    height, width = rows.shape[:2]
+    filtered = rows.astype(np.int16)
+    # Padded with a row of zeros above and a column of zeros on the left
+    pixels = np.zeros((height + 1, width + 1, 4), dtype=np.int16)
+    for step in range(width + height - 1):
+        y = np.arange(max(0, step - width + 1), min(height, step + 1))
+        x = step - y
+        predictors = _predictors(filter_types[y, None], pixels[y + 1, x],
+                                 pixels[y, x + 1], pixels[y, x])
+        pixels[y + 1, x + 1] = (filtered[y, x] + predictors) & 0xff
+    return pixels[1:, 1:].astype(np.uint8)
+
+
+def read_png(filepath):
+    """Read an 8 bit RGBA PNG written by write_png as a float array"""
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    width, height = struct.unpack('>II', data[16:24])
+    offset = 8
+    compressed = b''
+    while offset < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if chunk_type == b'IDAT':
+            compressed += data[offset + 8:offset + 8 + length]
+        offset += length + 12
+    rows = np.frombuffer(zlib.decompress(compressed), dtype=np.uint8)
+    rows = rows.reshape(height, width * 4 + 1)
+    filter_types = rows[:, 0]
+    rows = rows[:, 1:].reshape(height, width, 4)
+    if filter_types.any():
+        rows = _unfilter_rows(rows, filter_types)
+    # Blender stores images bottom to top
+    return rows[::-1].astype(np.float32) / 255
+
+
+def write_png(filepath, pixels, filters=(0,)):
+    """Write a (height, width, 4) float array as an 8 bit RGBA PNG.
+
+    Rows use the PNG filter types of filters in turn.
+    """
+    height, width = pixels.shape[:2]
+    rows = np.clip(np.rint(pixels[::-1] * 255), 0, 255).astype(np.uint8)
+    filter_types = np.resize(np.array(filters, dtype=np.uint8), height)
+    if filter_types.any():
+        rows = _filter_rows(rows, filter_types)
+    rows = np.column_stack((filter_types, rows.reshape(height, width * 4)))
+
+    def chunk(chunk_type, data):
+        return (struct.pack('>I', len(data)) + chunk_type + data
+                + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    with open(filepath, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 1)))
+        f.write(chunk(b'IEND', b''))
+
+
+class _Pixels:
+    """Image.pixels, a flat float array"""
+
+    def __init__(self, image):
+        self._image = image
+
+    def __len__(self):
+        return self._image._buffer().size
+
+    def __getitem__(self, key):
+        return self._image._buffer().ravel()[key].tolist()
+
+    def __setitem__(self, key, value):
+        self._image._buffer().ravel()[key] = value
+
+    def foreach_get(self, array):
+        array[:] = self._image._buffer().ravel()
+
+    def foreach_set(self, array):
+        self._image._buffer().ravel()[:] = array
+
+
+class Image(ID):
+    def __init__(self, name, width=0, height=0, alpha=False, float_buffer=False):
+        super().__init__(name)
+        self.filepath = ""
+        self.source = 'GENERATED' if width else 'FILE'
+        self.file_format = 'PNG'
+        self.use_alpha = alpha
+        self.is_float = float_buffer
+        self.packed_file = None
+        self.colorspace_settings = SimpleNamespace(name='sRGB')
+        self._size = (width, height)
+        self._pixels = None
+        if width:
+            self._pixels = np.zeros((height, width, 4), dtype=np.float32)
+
+    def _buffer(self):
+        if self._pixels is None:
+            path = abspath(self.filepath)
+            if os.path.isfile(path):
+                self._pixels = read_png(path)
+                self._size = (self._pixels.shape[1], self._pixels.shape[0])
+            else:
+                self._pixels = np.zeros((self._size[1], self._size[0], 4),
+                                        dtype=np.float32)
+        return self._pixels
+
+    @property
+    def filepath_raw(self):
+        return self.filepath
+
+    @filepath_raw.setter
+    def filepath_raw(self, value):
+        self.filepath = value
+
+    @property
+    def has_data(self):
+        return self._pixels is not None
+
+    @property
+    def size(self):
+        if self._pixels is None and self.source == 'FILE':
+            self._buffer()
+        return self._size
+
+    @property
+    def pixels(self):
+        return _Pixels(self)
+
+    def copy(self):
+        img = Image(self.name)
+        img.__dict__.update({k: v for k, v in self.__dict__.items()
+                             if k not in {'_collection', '_props', '_name'}})
+        img._props = dict(self._props)
+        if self._pixels is not None:
+            img._pixels = self._pixels.copy()
+        return data.images.link(img)
+
+    def reload(self):
+        self._pixels = None
+
+    def update(self):
+        pass
+
+    def scale(self, width, height):
+        pixels = self._buffer()
+        rows = np.linspace(0, pixels.shape[0] - 1, height).astype(int)
+        cols = np.linspace(0, pixels.shape[1] - 1, width).astype(int)
+        self._pixels = pixels[rows][:, cols]
+        self._size = (width, height)
+
+    def save_render(self, filepath, scene=None):
+        write_png(filepath, self._buffer())
+
+    def save(self):
+        write_png(abspath(self.filepath), self._buffer())
+
+
+def load_image(filepath, check_existing=False):
+    if check_existing:
+        for img in data.images:
+            if abspath(img.filepath) == abspath(filepath):
+                return img
+    img = Image(os.path.basename(filepath))
+    img.filepath = filepath
+    return data.images.link(img)
+
+
+# Textures and materials
+
+class Texture(ID):
+    def __init__(self, name, type='IMAGE'):
+        super().__init__(name)
+        self.type = type
+        self.image = None
+        self.use_color_ramp = False
+        self.intensity = 1.0
+        self.contrast = 1.0
+        self.saturation = 1.0
+
+
+class TextureSlot:
+    def __init__(self, texture=None):
+        self.texture = texture
+        self.use = True
+        self.texture_coords = 'UV'
+        self.blend_type = 'MIX'
+        self.use_map_color_diffuse = True
+        self.diffuse_color_factor = 1.0
+
+
+class TextureSlots(list):
+    def add(self):
+        for i, slot in enumerate(self):
+            if slot is None:
+                self[i] = TextureSlot()
+                return self[i]
+        self.append(TextureSlot())
+        return self[-1]
+
+
+class Socket:
+    def __init__(self, node, identifier, default_value=None):
+        self.node = node
+        self.identifier = identifier
+        self.name = identifier
+        self.default_value = default_value
+
+
+class Sockets:
+    def __init__(self, node, names):
+        self._sockets = {}
+        for name, value in names:
+            if isinstance(value, list):
+                value = list(value)
+            self._sockets[name] = Socket(node, name, value)
+
+    def __getitem__(self, key):
+        return self._sockets[key]
+
+    def __iter__(self):
+        return iter(self._sockets.values())
+
+
+class CurveMapPoint:
+    def __init__(self, x, y):
+        self.location = [x, y]
+        self.handle_type = 'AUTO'
+        self.select = False
+
+
+class CurveMapPoints(list):
+    def new(self, x, y):
+        self.append(CurveMapPoint(x, y))
+        return self[-1]
+
+    def remove(self, point):
+        list.remove(self, point)
+
+    def foreach_set(self, attribute, values):
+        for i, point in enumerate(self):
+            setattr(point, attribute, list(values[i * 2:i * 2 + 2]))
+
+
+class CurveMap:
+    def __init__(self):
+        self.extend = 'EXTRAPOLATED'
+        self.points = CurveMapPoints([CurveMapPoint(0.0, 0.0),
+                                      CurveMapPoint(1.0, 1.0)])
+
+    def evaluate(self, position):
+        points = sorted(self.points, key=lambda p: p.location[0])
+        return float(np.interp(position, [p.location[0] for p in points],
+                               [p.location[1] for p in points]))
+
+
+class CurveMapping:
+    def __init__(self):
+        self.black_level = [0.0, 0.0, 0.0]
+        self.white_level = [1.0, 1.0, 1.0]
+        self.clip_min_x = self.clip_min_y = 0.0
+        self.clip_max_x = self.clip_max_y = 1.0
+        self.use_clip = True
+        self.curves = [CurveMap() for i in range(4)]
+
+    def initialize(self):
+        pass
+
+    def update(self):
+        for curve in self.curves:
+            curve.points.sort(key=lambda p: p.location[0])
+
+
+# Node type -> (bl type, inputs, outputs)
+NODE_TYPES = {
+    'ShaderNodeMaterial': ('MATERIAL', [], ["Color", "Alpha"]),
+    'ShaderNodeOutput': ('OUTPUT', [("Color", None), ("Alpha", 1.0)], []),
+    'ShaderNodeGamma': ('GAMMA', [("Color", None), ("Gamma", 1.0)], ["Color"]),
+    'ShaderNodeHueSaturation': ('HUE_SAT', [
+        ("Color", None), ("Hue", 0.5), ("Saturation", 1.0), ("Value", 1.0),
+        ("Fac", 1.0)], ["Color"]),
+    'ShaderNodeRGBCurve': ('CURVE_RGB', [("Color", None), ("Fac", 1.0)], ["Color"]),
+    'ShaderNodeMixRGB': ('MIX_RGB', [
+        ("Color1", None), ("Color2", [0.5, 0.5, 0.5, 1.0]), ("Fac", 0.5)], ["Color"]),
+}
+
+NODE_NAMES = {
+    'ShaderNodeMaterial': "Material",
+    'ShaderNodeOutput': "Output",
+    'ShaderNodeGamma': "Gamma",
+    'ShaderNodeHueSaturation': "Hue Saturation Value",
+    'ShaderNodeRGBCurve': "RGB Curves",
+    'ShaderNodeMixRGB': "Mix",
+}
+
+
+class Node:
+    def __init__(self, bl_idname):
+        self.bl_idname = bl_idname
+        self.type, inputs, outputs = NODE_TYPES[bl_idname]
+        self.name = NODE_NAMES[bl_idname]
+        self.location = SimpleNamespace(x=0.0, y=0.0)
+        self.inputs = Sockets(self, inputs)
+        self.outputs = Sockets(self, [(name, None) for name in outputs])
+        self.material = None
+        if self.type == 'CURVE_RGB':
+            self.mapping = CurveMapping()
+
+
+class Nodes:
+    def __init__(self):
+        self._nodes = []
+
+    def new(self, bl_idname):
+        node = Node(bl_idname)
+        name = node.name
+        index = 1
+        while name in self:
+            name = "%s.%03d" % (node.name, index)
+            index += 1
+        node.name = name
+        self._nodes.append(node)
+        return node
+
+    def __getitem__(self, name):
+        for node in self._nodes:
+            if node.name == name:
+                return node
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return any(node.name == name for node in self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+
+class Link:
+    def __init__(self, from_socket, to_socket):
+        self.from_socket = from_socket
+        self.to_socket = to_socket
+        self.from_node = from_socket.node
+        self.to_node = to_socket.node
+
+
+class Links(list):
+    def new(self, from_socket, to_socket):
+        self[:] = [link for link in self if link.to_socket is not to_socket]
+        self.append(Link(from_socket, to_socket))
+        return self[-1]
+
+
+class NodeTree:
+    def __init__(self):
+        self.nodes = Nodes()
+        self.links = Links()
+
+    def as_pointer(self):
+        return id(self)
+
+
+class Material(ID):
+    def __init__(self, name):
+        super().__init__(name)
+        self.node_tree = None
+        self._use_nodes = False
+        self.use_shadeless = False
+        self.texture_slots = TextureSlots([None] * 18)
+
+    @property
+    def use_nodes(self):
+        return self._use_nodes
+
+    @use_nodes.setter
+    def use_nodes(self, value):
+        if value and self.node_tree is None:
+            self.node_tree = NodeTree()
+            self.node_tree.nodes.new('ShaderNodeMaterial')
+            self.node_tree.nodes.new('ShaderNodeOutput').location.x = 300
+        self._use_nodes = value
+
+    @property
+    def active_texture(self):
+        for slot in self.texture_slots:
+            if slot is not None and slot.texture is not None:
+                return slot.texture
+        return None
+
+
+# Objects and scenes
+
+class MaterialSlot:
+    def __init__(self, material):
+        self.material = material
+
+
+class _UVLoops(list):
+    def foreach_get(self, attr, array):
+        array[:] = np.ravel([getattr(loop, attr) for loop in self])
+
+
+class Mesh(ID):
+    def __init__(self, name):
+        super().__init__(name)
+        uv_layer = SimpleNamespace(
+            data=[SimpleNamespace(image=None) for i in range(8)])
+        self.uv_textures = SimpleNamespace(active=uv_layer)
+        uv_loops = _UVLoops(SimpleNamespace(uv=(i % 2, i // 2 % 2))
+                            for i in range(8))
+        self.uv_layers = SimpleNamespace(active=SimpleNamespace(data=uv_loops))
+
+
+class Object(ID):
+    def __init__(self, name, mesh=None):
+        super().__init__(name)
+        self.type = 'MESH'
+        self.data = mesh
+        self.material_slots = []
+        self.hide = self.hide_select = self.hide_render = False
+        self.select = False
+        self.animation_data = None
+
+    @property
+    def active_material(self):
+        return self.material_slots[0].material if self.material_slots else None
+
+    def is_visible(self, scene):
+        return not self.hide
+
+
+class SceneObjects(list):
+    active = None
+
+
+class Scene(ID):
+    def __init__(self, name):
+        super().__init__(name)
+        self.objects = SceneObjects()
+        self.imported_items = []
+        self.camera = None
+        self.render = SimpleNamespace(
+            engine='BLENDER_RENDER',
+            image_settings=SimpleNamespace())
+
+
+class Operator(metaclass=_Types):
+    def report(self, type, message):
+        pass
+
+
+class Panel(metaclass=_Types):
+    pass
+
+
+class PropertyGroup(metaclass=_Types):
+    pass
+
+
+class WindowManager(metaclass=_Types):
+    pass
+
+
+class AddonPreferences(metaclass=_Types):
+    pass
+
+
+types = SimpleNamespace(
+    ID=ID, Image=Image, Material=Material, Object=Object, Scene=Scene,
+    Operator=Operator, Panel=Panel, AddonPreferences=AddonPreferences,
+    PropertyGroup=PropertyGroup, WindowManager=WindowManager)
+
+
+# Application
+
+def _persistent(function):
+    return function
+
+
+app = SimpleNamespace(
+    binary_path=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "fake_blender.py"),
+    handlers=SimpleNamespace(
+        persistent=_persistent, load_post=[], undo_post=[], redo_post=[],
+        scene_update_post=[]),
+)
+
+
+def abspath(path):
+    if path.startswith('//'):
+        return os.path.join(os.path.dirname(data.filepath), path[2:])
+    return path
+
+
+path = SimpleNamespace(
+    abspath=abspath,
+    clean_name=lambda name: "".join(c if c.isalnum() else "_" for c in name))
+
+utils = SimpleNamespace(
+    register_class=lambda cls: None,
+    unregister_class=lambda cls: None,
+    register_module=lambda name: None,
+    unregister_module=lambda name: None,
+    user_resource=lambda kind, path="": os.path.join(os.path.expanduser("~"), path),
+)
+
+ops = SimpleNamespace(object=SimpleNamespace(
+    bake_image=lambda *args, **kwargs: {'FINISHED'},
+    mode_set=lambda **kwargs: {'FINISHED'},
+))
+
+data = SimpleNamespace(
+    filepath="",
+    images=IDCollection(Image),
+    textures=IDCollection(Texture),
+    materials=IDCollection(Material),
+    meshes=IDCollection(Mesh),
+    objects=IDCollection(Object),
+    groups=IDCollection(ID),
+    scenes=IDCollection(Scene),
+)
+data.images.load = load_image
+
+context = SimpleNamespace(
+    scene=None, object=None, selected_objects=[], screen=None,
+    window_manager=WindowManager(),
+    user_preferences=SimpleNamespace(addons={}),
+)
+
+
+def reset():
+    """Empty bpy.data and create a new scene"""
+    for collection in vars(data).values():
+        if isinstance(collection, IDCollection):
+            collection.clear()
+    context.scene = data.scenes.new("Scene")
+    context.object = None
+    context.selected_objects = []
+
+
+def _stub_module(name, **attributes):
+    module = ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def _not_implemented(*args, **kwargs):
+    raise NotImplementedError("Not available without Blender")
+
+
+def install():
+    """Make this module importable as bpy"""
+    module = sys.modules[__name__]
+    sys.modules['bpy'] = module
+    # Cameras are not simulated, these are only there to be imported
+    _stub_module('mathutils', Vector=_not_implemented)
+    object_utils = _stub_module('bpy_extras.object_utils',
+                                world_to_camera_view=_not_implemented)
+    _stub_module('bpy_extras', object_utils=object_utils)
+    reset()
+    return module
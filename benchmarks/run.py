@@ -0,0 +1,392 @@
+# Copyright (C) 2017 Les Fees Speciales
+# voeu@les-fees-speciales.coop
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmarks of the proxify and material tuning hot paths.
+
+Runs with a plain Python interpreter and numpy, without Blender:
+
+    python benchmarks/run.py
+    python benchmarks/run.py --objects 2000 --resolution 2048 --only proxify
+    python benchmarks/run.py --update-baseline
+
+A scene of synthetic objects, materials and PNG images is built with the
+fake bpy module, then each operation is timed, keeping the best of
+--repeat runs. Times are compared with baseline.json, and the script
+exits with 1 if one is slower than its baseline by more than --tolerance.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import collections
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import fake_bpy
+
+bpy = fake_bpy.install()
+
+import proxify
+import material_tuning
+
+proxify.register()
+material_tuning.register()
+
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "baseline.json")
+
+# Scene parameters, also stored with the baseline
+SCENE_PARAMS = ("objects", "materials", "images", "resolution", "tunings",
+                "curve_points")
+
+
+# Filter types of the scanlines of stream_proxies sources, mostly Paeth
+# like the adaptive filtering of libpng on photographs
+PNG_FILTERS = (4, 1, 4, 2, 4, 3, 4, 0)
+
+
+def write_images(directory, count, resolution, filters=(0,), name="texture"):
+    """Write count noisy gradient PNG images, return their paths.
+
+    Their scanlines use the PNG filter types of filters in turn.
+    """
+    rng = np.random.RandomState(0)
+    y, x = np.mgrid[0:resolution, 0:resolution] / resolution
+    paths = []
+    for i in range(count):
+        pixels = np.empty((resolution, resolution, 4), dtype=np.float32)
+        pixels[..., 0] = x
+        pixels[..., 1] = y
+        pixels[..., 2] = (i + 1) / count
+        pixels[..., 3] = 1.0
+        pixels[..., :3] += rng.uniform(-0.05, 0.05, (resolution, resolution, 3))
+        path = os.path.join(directory, "%s_%03d.png" % (name, i))
+        fake_bpy.write_png(path, np.clip(pixels, 0.0, 1.0), filters)
+        paths.append(path)
+    return paths
+
+
+def make_tuning(index, curve_points):
+    """Return a tuning with curve_points points on each curve"""
+    rng = np.random.RandomState(index)
+    mat = bpy.data.materials.new("tuning_%d" % index)
+    material_tuning.setup_material_node_tree(mat)
+    tuning = material_tuning.read_tuning(mat)
+    bpy.data.materials.remove(mat)
+    tuning["Gamma"]["Gamma"] = float(rng.uniform(0.6, 1.6))
+    tuning["Hue Saturation Value"].update(
+        Hue=float(rng.uniform(0.3, 0.7)),
+        Saturation=float(rng.uniform(0.5, 1.5)),
+        Value=float(rng.uniform(0.8, 1.2)))
+    tuning["Mix"].update(
+        Color2=[float(c) for c in rng.uniform(0.0, 1.0, 3)] + [1.0],
+        Fac=float(rng.uniform(0.0, 0.5)))
+    xs = np.linspace(0.0, 1.0, curve_points)
+    for curve in tuning["RGB Curves"]["curves"]:
+        ys = np.clip(xs + rng.uniform(-0.1, 0.1, curve_points), 0.0, 1.0)
+        curve["points"] = [[float(x), float(y), 'AUTO'] for x, y in zip(xs, ys)]
+    return tuning
+
+
+def build_scene(directory, image_paths, args):
+    """Fill bpy.data with objects, tuned shadeless materials and images"""
+    bpy.reset()
+    bpy.data.filepath = os.path.join(directory, "scene.blend")
+    material_tuning._pantin_indices.clear()
+    material_tuning._material_indices.clear()
+    proxify.proxy_registry.invalidate()
+
+    scene = bpy.context.scene
+    scene.proxy_width_threshold = args.resolution // 4
+    scene.proxy_destination = args.resolution // 2
+    scene.proxy_levels = str(args.resolution // 4)
+    scene.proxy_format = 'PNG'
+    scene.proxy_workers = args.workers
+    scene.proxy_stream_threshold = 0
+
+    images = []
+    for path in image_paths:
+        img = bpy.data.images.load(path)
+        images.append(img)
+
+    tunings = [make_tuning(i, args.curve_points) for i in range(args.tunings)]
+    materials = []
+    for i in range(args.materials):
+        mat = bpy.data.materials.new("material_%03d" % i)
+        mat.use_shadeless = True
+        tex = bpy.data.textures.new("texture_%03d" % i, 'IMAGE')
+        tex.image = images[i % len(images)]
+        mat.texture_slots.add().texture = tex
+        material_tuning.setup_material_node_tree(mat)
+        material_tuning.write_tuning(mat, tunings[i % len(tunings)])
+        materials.append(mat)
+
+    for i in range(args.objects):
+        mesh = bpy.data.meshes.new("mesh_%04d" % i)
+        obj = bpy.data.objects.new("object_%04d" % i, mesh)
+        obj.material_slots.append(fake_bpy.MaterialSlot(materials[i % len(materials)]))
+        obj.select = True
+        scene.objects.append(obj)
+
+    bpy.context.selected_objects = list(scene.objects)
+    bpy.context.object = scene.objects.active = scene.objects[0]
+    return tunings
+
+
+def deproxify_all():
+    images = proxify.images_to_deproxify(
+        proxify.proxy_registry.proxies() + proxify.proxy_registry.orphans())
+    for progress in proxify.iter_deproxify_images(images):
+        if progress is None:
+            time.sleep(0.01)
+
+
+def clear_proxy_cache(directory):
+    shutil.rmtree(os.path.join(directory, "proxy"), ignore_errors=True)
+
+
+class Benchmark:
+    """A timed operation.
+
+    setup() runs before each timed run and is not measured. run() returns
+    the number of items processed, for throughput.
+    """
+
+    def __init__(self, name, unit, run, setup=None):
+        self.name = name
+        self.unit = unit
+        self.run = run
+        self.setup = setup
+
+    def measure(self, repeat):
+        best = None
+        for i in range(repeat):
+            if self.setup is not None:
+                self.setup()
+            start = time.perf_counter()
+            count = self.run()
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best:
+                best = seconds
+        return best, count
+
+
+def benchmarks(directory, image_paths, args):
+    """Return the benchmarks, by name"""
+    state = {}
+    # stream_proxies decodes PNG files itself, so its sources have filtered
+    # scanlines. The stand-in loader undoes filters far slower than Blender.
+    stream_paths = write_images(directory, min(4, len(image_paths)),
+                                args.resolution, PNG_FILTERS, "stream_source")
+
+    def scene():
+        state["tunings"] = build_scene(directory, image_paths, args)
+
+    def fresh_scene():
+        scene()
+        clear_proxy_cache(directory)
+
+    def probe_headers():
+        proxify._image_info_cache.clear()
+        for img in bpy.data.images:
+            proxify.image_width(img)
+        return len(bpy.data.images)
+
+    def collect_images():
+        for i in range(10):
+            proxify.get_selected_images()
+        return 10 * len(bpy.context.selected_objects)
+
+    def proxify_images():
+        failed = proxify.proxify_images(list(bpy.data.images))
+        if failed:
+            raise RuntimeError("Could not proxify %d images" % len(failed))
+        return len(image_paths)
+
+    def cached_scene():
+        scene()
+        proxify_images()
+        deproxify_all()
+
+    def deproxify_scene():
+        scene()
+        proxify_images()
+
+    def deproxify():
+        count = len(proxify.proxy_registry.proxies())
+        deproxify_all()
+        return count
+
+    def stream_proxies():
+        levels = [(os.path.join(directory, "stream", "stream_%d.png" % width), width)
+                  for width in (args.resolution // 2, args.resolution // 4)]
+        for path in stream_paths:
+            list(proxify.stream_proxies(path, levels))
+        return len(stream_paths)
+
+    def copy_to_selected():
+        material_tuning.copy_to_selected(bpy.context.object,
+                                         bpy.context.selected_objects)
+        return len(bpy.context.selected_objects)
+
+    def reset_all():
+        for obj in bpy.context.selected_objects:
+            bpy.context.object = obj
+            material_tuning.reset_all()
+        return len(bpy.context.selected_objects)
+
+    def apply_tuning():
+        pixels = np.random.RandomState(0).uniform(
+            0.0, 1.0, (args.resolution, args.resolution, 4)).astype(np.float32)
+        params = material_tuning.tuning_parameters(bpy.data.materials[0])
+        material_tuning.apply_tuning(pixels, params)
+        return 1
+
+    def bake_scene():
+        scene()
+        shutil.rmtree(os.path.join(directory, "textures"), ignore_errors=True)
+
+    def bake_all_textures():
+        material_tuning.bake_all_textures(bpy.types.Operator())
+        return args.materials
+
+    def baked_scene():
+        bake_scene()
+        bake_all_textures()
+        scene()
+
+    return collections.OrderedDict((b.name, b) for b in [
+        Benchmark("probe_headers", "images", probe_headers, scene),
+        Benchmark("get_selected_images", "objects", collect_images, scene),
+        Benchmark("proxify_cold", "images", proxify_images, fresh_scene),
+        Benchmark("proxify_cached", "images", proxify_images, cached_scene),
+        Benchmark("deproxify", "images", deproxify, deproxify_scene),
+        Benchmark("stream_proxies", "images", stream_proxies),
+        Benchmark("copy_to_selected", "objects", copy_to_selected, scene),
+        Benchmark("reset_all", "objects", reset_all, scene),
+        Benchmark("apply_tuning", "images", apply_tuning, scene),
+        Benchmark("bake_all_textures", "materials", bake_all_textures, bake_scene),
+        Benchmark("bake_up_to_date", "materials", bake_all_textures, baked_scene),
+    ])
+
+
+def compare(results, baseline, tolerance, noise):
+    """Print results against the baseline, return the names of regressions.
+
+    Differences under noise seconds are never regressions, as timings of
+    very short operations vary too much.
+    """
+    regressions = []
+    print("%-20s %10s %22s %10s %8s" % (
+        "benchmark", "seconds", "throughput", "baseline", "change"))
+    for name, result in results.items():
+        reference = baseline.get(name)
+        change = ""
+        if reference:
+            ratio = result["seconds"] / reference
+            change = "%+.0f%%" % ((ratio - 1) * 100)
+            if ratio > 1 + tolerance and result["seconds"] - reference > noise:
+                regressions.append(name)
+                change += " !"
+        print("%-20s %10.4f %12.1f %-9s %10s %8s" % (
+            name, result["seconds"], result["throughput"], "%s/s" % result["unit"],
+            "%.4f" % reference if reference else "-", change))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="run.py")
+    parser.add_argument('--objects', type=int, default=500)
+    parser.add_argument('--materials', type=int, default=48)
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--resolution', type=int, default=512,
+                        help="Width and height of the images")
+    parser.add_argument('--tunings', type=int, default=4,
+                        help="Number of distinct tunings among the materials")
+    parser.add_argument('--curve-points', type=int, default=16,
+                        help="Points on each RGB curve of the tunings")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Proxy worker processes (0 for all cores)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', help="Benchmarks to run")
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help="Allowed slowdown against the baseline, as a fraction")
+    parser.add_argument('--noise', type=float, default=0.005,
+                        help="Slowdowns under this many seconds are ignored")
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="material_utils_bench_")
+    try:
+        print("Writing %d images of %dx%d..." % (
+            args.images, args.resolution, args.resolution))
+        image_paths = write_images(directory, args.images, args.resolution)
+        all_benchmarks = benchmarks(directory, image_paths, args)
+        names = args.only or list(all_benchmarks)
+        unknown = set(names) - set(all_benchmarks)
+        if unknown:
+            parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+        results = collections.OrderedDict()
+        for name in names:
+            benchmark = all_benchmarks[name]
+            seconds, count = benchmark.measure(args.repeat)
+            results[name] = {"seconds": seconds, "count": count,
+                             "unit": benchmark.unit,
+                             "throughput": count / seconds if seconds else 0.0}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    params = {name: getattr(args, name) for name in SCENE_PARAMS}
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored["params"] == params:
+            baseline = stored["seconds"]
+        else:
+            print("Baseline was measured with other scene parameters, not comparing")
+    regressions = compare(results, baseline, args.tolerance, args.noise)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"params": params, "results": results}, f, indent=2)
+    if args.update_baseline:
+        seconds = dict(baseline)
+        seconds.update((name, result["seconds"]) for name, result in results.items())
+        with open(args.baseline, 'w') as f:
+            json.dump({"params": params, "seconds": seconds}, f,
+                      indent=2, sort_keys=True)
+        print("Baseline written to %s" % args.baseline)
+        return 0
+    if regressions:
+        print("Slower than baseline: %s" % ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -27,6 +27,15 @@ bl_info = {
 
 import bpy
 import os
+import json
+import collections
+import fnmatch
+import hashlib
+import time
+import concurrent.futures
+import numpy as np
+from stage_report import (StageReport, stage_totals, slowest_items,
+                          write_report, image_memory)
 
 NODE_SETTINGS = [
     {
@@ -71,82 +80,322 @@ NODE_SETTINGS = [
     }
 ]
 
+# Properties of the RGB Curves mapping copied along with its curves
+CURVE_MAPPING_PROPS = ["black_level", "clip_max_x", "clip_max_y",
+                       "clip_min_x", "clip_min_y", "white_level", "use_clip"]
+
+
+# Number of samples of the RGB curves lookup tables
+CURVE_LUT_SIZE = 1024
+
+
+def rgb_to_hsv(rgb):
+    """Vectorized conversion of a (..., 3) RGB array to HSV"""
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    cmax = rgb.max(axis=-1)
+    delta = cmax - rgb.min(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(cmax != 0.0, delta / cmax, 0.0)
+        h = np.where(r == cmax, (g - b) / delta,
+                     np.where(g == cmax, 2.0 + (b - r) / delta,
+                              4.0 + (r - g) / delta))
+    h = np.where(s != 0.0, h / 6.0, 0.0)
+    h = np.where(h < 0.0, h + 1.0, h)
+    return np.stack((h, s, cmax), axis=-1)
+
+
+def hsv_to_rgb(hsv):
+    """Vectorized conversion of a (..., 3) HSV array to RGB"""
+    h, s, v = hsv[..., 0:1], hsv[..., 1:2], hsv[..., 2:3]
+    n = np.abs(h * 6.0 - np.array([3.0, 2.0, 4.0])) * np.array([1.0, -1.0, -1.0]) \
+        + np.array([-1.0, 2.0, 2.0])
+    n = np.clip(n, 0.0, 1.0)
+    return ((n - 1.0) * s + 1.0) * v
 
-def setup_node_tree(obj):
-    """If object is not properly setup, create node tree."""
-    mat = obj.active_material
-    mat.use_nodes = True
 
+def _lookup(x, xs, ys, extrapolate):
+    """Interpolate x in a lookup table, extending it linearly if extrapolate"""
+    y = np.interp(x, xs, ys)
+    if extrapolate:
+        start = (ys[1] - ys[0]) / (xs[1] - xs[0])
+        end = (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
+        y = np.where(x < xs[0], ys[0] + (x - xs[0]) * start, y)
+        y = np.where(x > xs[-1], ys[-1] + (x - xs[-1]) * end, y)
+    return y
+
+
+def curve_lookup_tables(node, size=CURVE_LUT_SIZE):
+    """Sample the curves of an RGB Curves node.
+
+    Return (xs, luts, extrapolate): the sample positions, a (4, size) array
+    of R, G, B and combined curve values, and whether each curve is
+    extrapolated.
+    """
+    mapping = node.mapping
+    mapping.initialize()
+    xs = np.linspace(min(0.0, mapping.clip_min_x), max(1.0, mapping.clip_max_x),
+                     size)
+    luts = np.array([[curve.evaluate(x) for x in xs]
+                     for curve in mapping.curves])
+    extrapolate = [curve.extend == 'EXTRAPOLATED' for curve in mapping.curves]
+    return xs, luts, extrapolate
+
+
+def tuning_parameters(mat):
+    """Read the parameters of the tuning chain of a material"""
     nodes = mat.node_tree.nodes
+    hsv = nodes["Hue Saturation Value"].inputs
+    mix = nodes["Mix"].inputs
+    return {
+        "gamma": nodes["Gamma"].inputs["Gamma"].default_value,
+        "hue": hsv["Hue"].default_value,
+        "saturation": hsv["Saturation"].default_value,
+        "value": hsv["Value"].default_value,
+        "curves": curve_lookup_tables(nodes["RGB Curves"]),
+        "color": tuple(mix["Color2"].default_value),
+        "fac": mix["Fac"].default_value,
+    }
+
+
+def apply_tuning(pixels, params):
+    """Apply the tuning chain to a (..., 4) array of RGBA pixels.
+
+    This mirrors the Blender Internal nodes listed in NODE_SETTINGS, from
+    Gamma to Mix. Alpha is left untouched. Return a new array.
+    """
+    rgb = pixels[..., :3].astype(np.float32)
+
+    # Gamma
+    rgb = np.where(rgb > 0.0, np.power(np.maximum(rgb, 0.0), params["gamma"]), rgb)
+
+    # Hue Saturation Value
+    hsv = rgb_to_hsv(rgb)
+    h = hsv[..., 0] + params["hue"] - 0.5
+    hsv[..., 0] = np.where(h > 1.0, h - 1.0, np.where(h < 0.0, h + 1.0, h))
+    hsv[..., 1] = np.clip(hsv[..., 1] * params["saturation"], 0.0, 1.0)
+    hsv[..., 2] *= params["value"]
+    rgb = hsv_to_rgb(hsv)
+
+    # RGB Curves: combined curve first, then each channel
+    xs, luts, extrapolate = params["curves"]
+    for c in range(3):
+        channel = _lookup(rgb[..., c], xs, luts[3], extrapolate[3])
+        rgb[..., c] = _lookup(channel, xs, luts[c], extrapolate[c])
+
+    # Mix, hue blending
+    color = np.array(params["color"][:3], dtype=np.float32)
+    color_h, color_s, color_v = rgb_to_hsv(color)
+    if color_s != 0.0:
+        hsv = rgb_to_hsv(rgb)
+        hsv[..., 0] = color_h
+        fac = params["fac"]
+        rgb = (1.0 - fac) * rgb + fac * hsv_to_rgb(hsv)
+
+    result = np.array(pixels, dtype=np.float32)
+    result[..., :3] = rgb
+    return result
+
+
+def read_pixels(img):
+    """Return the pixels of an image as a (height, width, 4) float array"""
+    width, height = img.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    if hasattr(img.pixels, "foreach_get"):
+        img.pixels.foreach_get(pixels)
+    else:
+        pixels[:] = img.pixels[:]
+    return pixels.reshape(height, width, 4)
+
+
+def write_pixels(img, pixels):
+    """Set the pixels of an image from a (height, width, 4) float array"""
+    pixels = np.ascontiguousarray(pixels, dtype=np.float32).ravel()
+    if hasattr(img.pixels, "foreach_set"):
+        img.pixels.foreach_set(pixels)
+    else:
+        img.pixels[:] = pixels.tolist()
+
+
+def _plain(value):
+    """Convert a property value to a list, or leave it as is"""
+    try:
+        return list(value)
+    except TypeError:
+        return value
+
+
+def read_tuning(mat):
+    """Return the tuning settings of a material as plain Python values.
+
+    The result only holds dicts, lists, numbers and strings, so it can be
+    compared, hashed and serialized.
+    """
+    nodes = mat.node_tree.nodes
+    tuning = {}
+    for node_s in NODE_SETTINGS:
+        node = nodes[node_s["name"]]
+        values = {prop: _plain(node.inputs[prop].default_value)
+                  for prop in node_s["inputs"]}
+        if node.type == "CURVE_RGB":
+            values["mapping"] = {prop: _plain(getattr(node.mapping, prop))
+                                 for prop in CURVE_MAPPING_PROPS}
+            values["curves"] = [
+                {"extend": curve.extend,
+                 "points": [[point.location[0], point.location[1],
+                             point.handle_type]
+                            for point in curve.points]}
+                for curve in node.mapping.curves]
+        tuning[node_s["name"]] = values
+    return tuning
+
+
+def _rounded(value, digits=6):
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, list):
+        return [_rounded(v, digits) for v in value]
+    if isinstance(value, dict):
+        return {k: _rounded(v, digits) for k, v in value.items()}
+    return value
 
-    input_node = nodes["Material"]
-    input_node.material = mat
-    output_node = nodes["Output"]
-    output_node.location.x = (len(NODE_SETTINGS)+1) * 300
-    mat.node_tree.links.new(input_node.outputs["Alpha"],
-                            output_node.inputs["Alpha"], )
+
+def tuning_signature(tuning):
+    """Return a hash identifying tuning settings, ignoring float noise"""
+    data = json.dumps(_rounded(tuning), sort_keys=True)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def setup_material_node_tree(mat):
+    """Create the missing parts of the tuning node tree of a material.
+
+    Existing nodes keep their values, and only missing links are added, so
+    calling this again on a set up material changes nothing.
+    Return whether the node tree was modified.
+    """
+    changed = not mat.use_nodes
+    mat.use_nodes = True
+
+    tree = mat.node_tree
+    nodes = tree.nodes
+    existing_links = {(link.from_node.name, link.from_socket.identifier,
+                       link.to_node.name, link.to_socket.identifier)
+                      for link in tree.links}
+
+    def link(from_socket, to_socket):
+        key = (from_socket.node.name, from_socket.identifier,
+               to_socket.node.name, to_socket.identifier)
+        if key not in existing_links:
+            tree.links.new(from_socket, to_socket)
+            existing_links.add(key)
+            return True
+        return False
+
+    def get_node(name, node_type):
+        if name in nodes:
+            return nodes[name], False
+        node = nodes.new(node_type)
+        node.name = name
+        return node, True
+
+    input_node, input_new = get_node("Material", "ShaderNodeMaterial")
+    if input_node.material is None:
+        input_node.material = mat
+    output_node, output_new = get_node("Output", "ShaderNodeOutput")
+    new_nodes = [node_s["name"] for node_s in NODE_SETTINGS
+                 if node_s["name"] not in nodes]
+    if output_new or new_nodes:
+        output_node.location.x = (len(NODE_SETTINGS)+1) * 300
+    changed |= input_new or output_new or bool(new_nodes)
+    changed |= link(input_node.outputs["Alpha"], output_node.inputs["Alpha"])
     previous_node = input_node
 
     for i, node_s in enumerate(NODE_SETTINGS):
-        if not node_s["name"] in nodes:
-            node = nodes.new(node_s["type"])
+        node, new = get_node(node_s["name"], node_s["type"])
+        if new:
             node.location.x = ((input_node.location.x + output_node.location.x)
                                * (i+1) / (len(NODE_SETTINGS)+1))
             node.location.y = (input_node.location.y
                                + output_node.location.y) / 2
-            input_socket = node_s["input_socket"]
-            mat.node_tree.links.new(previous_node.outputs["Color"],
-                                    node.inputs[input_socket], )
-            previous_node = node
-        if "settings" in node_s:
-            for setting, value in node_s["settings"].items():
-                setattr(node, setting, value)
-        if "default_values" in node_s:
-            for input_socket, value in node_s["default_values"].items():
-                node.inputs[input_socket].default_value = value
+            if "settings" in node_s:
+                for setting, value in node_s["settings"].items():
+                    setattr(node, setting, value)
+            if "default_values" in node_s:
+                for input_socket, value in node_s["default_values"].items():
+                    node.inputs[input_socket].default_value = value
+        changed |= link(previous_node.outputs["Color"],
+                        node.inputs[node_s["input_socket"]])
+        previous_node = node
+
+    changed |= link(previous_node.outputs["Color"],
+                    output_node.inputs["Color"])
+    return changed
+
+
+def setup_node_tree(obj):
+    """If object is not properly setup, create node tree."""
+    return setup_material_node_tree(obj.active_material)
+
+
+def is_tuned(mat):
+    """Return whether a material has at least part of the tuning node tree"""
+    return (mat.use_nodes and mat.node_tree is not None
+            and any(node_s["name"] in mat.node_tree.nodes
+                    for node_s in NODE_SETTINGS))
+
 
-    mat.node_tree.links.new(node.outputs["Color"],
-                            output_node.inputs["Color"],)
+def has_tuning_chain(mat):
+    """Return whether a material has all the nodes of the tuning chain"""
+    return (mat.use_nodes and mat.node_tree is not None
+            and all(node_s["name"] in mat.node_tree.nodes
+                    for node_s in NODE_SETTINGS))
+
+
+def write_curve_mapping(mapping, values):
+    """Set an RGB Curves mapping from values read by read_tuning()"""
+    for prop, value in values["mapping"].items():
+        setattr(mapping, prop, value)
+    mapping.initialize()
+    for curve, curve_values in zip(mapping.curves, values["curves"]):
+        curve.extend = curve_values["extend"]
+        points = curve_values["points"]
+        # Match number of points
+        while len(curve.points) < len(points):
+            curve.points.new(0, 0)
+        while len(curve.points) > len(points):
+            curve.points.remove(curve.points[-1])
+        # Copy points
+        curve.points.foreach_set(
+            "location", [c for x, y, handle_type in points for c in (x, y)])
+        for point, (x, y, handle_type) in zip(curve.points, points):
+            if point.handle_type != handle_type:
+                point.handle_type = handle_type
+            point.select = True
+    mapping.update()
+
+
+def write_tuning(mat, tuning):
+    """Set the tuning settings of a material from read_tuning() values"""
+    nodes = mat.node_tree.nodes
+    for node_s in NODE_SETTINGS:
+        node = nodes[node_s["name"]]
+        values = tuning[node_s["name"]]
+        for prop in node_s["inputs"]:
+            node.inputs[prop].default_value = values[prop]
+        # Hack for curves
+        if node.type == "CURVE_RGB":
+            write_curve_mapping(node.mapping, values)
 
 
 def copy_to_selected(obj, selected_objs):
-    """Copy tuning settings from active to selected objects"""
+    """Copy tuning settings from active to selected objects.
+
+    The settings are read once, and each material shared by several
+    objects is written once.
+    """
     mat = obj.active_material
-    for so in selected_objs:
-        so_mat = so.active_material
-        if so_mat is not None:
-            if not so_mat.use_nodes:
-                setup_node_tree(so)
-            for node_s in NODE_SETTINGS:
-                node = mat.node_tree.nodes[node_s["name"]]
-                so_node = so_mat.node_tree.nodes[node_s["name"]]
-                for prop in node_s["inputs"]:
-                    so_node.inputs[prop].default_value = \
-                        node.inputs[prop].default_value
-                # Hack for curves
-                if node.type == "CURVE_RGB":
-                    for prop in ["black_level", "clip_max_x", "clip_max_y",
-                                 "clip_min_x", "clip_min_y", "white_level",
-                                 "use_clip"]:
-                        setattr(so_node.mapping,
-                                prop,
-                                getattr(node.mapping, prop))
-                    so_node.mapping.initialize()
-                    for so_curve, curve in zip(
-                            so_node.mapping.curves, node.mapping.curves):
-                        so_curve.extend = curve.extend
-                        # Match number of points
-                        while len(so_curve.points) < len(curve.points):
-                            so_curve.points.new(0, 0)
-                        while len(so_curve.points) > len(curve.points):
-                            so_curve.points.remove(so_curve.points[0])
-                        # Copy points
-                        for so_point, point in zip(so_curve.points,
-                                                   curve.points):
-                            so_point.handle_type = point.handle_type
-                            so_point.location = point.location
-                            so_point.select = True
-                    so_node.mapping.update()
+    apply_tuning_to_objects(
+        read_tuning(mat),
+        [so for so in selected_objs if so.active_material != mat])
 
 
 class SetupNodeTree(bpy.types.Operator):
@@ -164,6 +413,78 @@ class SetupNodeTree(bpy.types.Operator):
         return {"FINISHED"}
 
 
+class SetupAllNodeTrees(bpy.types.Operator):
+    """Create or repair the material tuning node tree of all materials in the file"""
+    bl_idname = "lfs.tuning_setup_all_node_trees"
+    bl_label = "Setup All Node Trees"
+    bl_options = {"REGISTER", "UNDO"}
+
+    all_materials = bpy.props.BoolProperty(
+        name="All Materials",
+        description="Also set up materials which do not use tuning yet")
+
+    def execute(self, context):
+        changed = 0
+        for mat in bpy.data.materials:
+            if mat.library is not None:
+                continue
+            if self.all_materials or is_tuned(mat):
+                changed += setup_material_node_tree(mat)
+        self.report({"INFO"}, "Updated %d materials" % changed)
+        return {"FINISHED"}
+
+
+class PantinIndex:
+    """Pantins imported in a scene, by asset uuid.
+
+    Maps each uuid to the pantin name and its mesh objects, resolved once
+    instead of scanning imported_items and bpy.data.objects on each call.
+    The index is empty when the pantin importer add-on is not enabled.
+    """
+
+    def __init__(self, scene):
+        self.names = {}
+        self.objects = {}
+        for pantin in getattr(scene, 'imported_items', ()):
+            objects = []
+            for db in pantin.datablocks:
+                obj = bpy.data.objects.get(db.db_name)
+                if obj is not None and obj.type == 'MESH':
+                    objects.append(obj)
+            self.names.setdefault(pantin.asset_uuid, pantin.name)
+            self.objects.setdefault(pantin.asset_uuid, objects)
+
+
+# scene name -> PantinIndex, dropped when objects change
+_pantin_indices = {}
+
+
+def pantin_index(scene):
+    """Return the pantin index of a scene, building it if needed"""
+    if scene.name not in _pantin_indices:
+        _pantin_indices[scene.name] = PantinIndex(scene)
+    return _pantin_indices[scene.name]
+
+
+def pantin_objects(scene, asset_uuid):
+    """Return the mesh objects of the pantin with the given uuid"""
+    return list(pantin_index(scene).objects.get(asset_uuid, []))
+
+
+def target_objects(operator, context):
+    """Return the objects an operator with a to_pantin option applies to.
+
+    Return None and report an error if the active object is not part of
+    a pantin.
+    """
+    if operator.to_pantin:
+        if not "asset_uuid" in context.object:
+            operator.report({"ERROR"}, "Active object is not part of a pantin")
+            return None
+        return pantin_objects(context.scene, context.object["asset_uuid"])
+    return context.selected_objects
+
+
 class CopyTuningToSelected(bpy.types.Operator):
     """Copy node tree for material tuning"""
     bl_idname = "lfs.tuning_copy_to_selected"
@@ -177,27 +498,513 @@ class CopyTuningToSelected(bpy.types.Operator):
         return context.object is not None
 
     def execute(self, context):
-        if self.to_pantin:
-            if not "asset_uuid" in context.object:
-                self.report({"ERROR"}, "Active object is not part of a pantin")
-                return {"CANCELLED"}
-            else:
-                dest_objects = []
-                # Get pantin
-                for pantin in context.scene.imported_items:
-                    if pantin.asset_uuid == context.object["asset_uuid"]:
-                        break
-                for db in pantin.datablocks:
-                    if (db.db_name in bpy.data.objects
-                            and bpy.data.objects[db.db_name].type == 'MESH'):
-                        dest_objects.append(bpy.data.objects[db.db_name])
-        else:
-            dest_objects = context.selected_objects
+        dest_objects = target_objects(self, context)
+        if dest_objects is None:
+            return {"CANCELLED"}
         copy_to_selected(context.object, dest_objects)
         return {"FINISHED"}
 
 
-def bake_all_textures(self):
+PRESET_EXTENSION = ".json"
+
+# Preset file path -> (modification time, tuning), filled on first use
+_preset_cache = {}
+
+
+def preset_directory():
+    """Return the directory of the shared tuning preset library"""
+    addon = bpy.context.user_preferences.addons.get(__name__)
+    if addon is not None and addon.preferences.preset_directory:
+        return bpy.path.abspath(addon.preferences.preset_directory)
+    return os.path.join(bpy.utils.user_resource('SCRIPTS', "presets"),
+                        "material_tuning")
+
+
+def list_presets():
+    """Return the sorted names of available presets, without reading them"""
+    directory = preset_directory()
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(directory)
+                  if f.endswith(PRESET_EXTENSION))
+
+
+def load_preset(name):
+    """Return the tuning stored in a preset, read again only if it changed"""
+    path = os.path.join(preset_directory(), name + PRESET_EXTENSION)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _preset_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            cached = (mtime, json.load(f)["tuning"])
+        _preset_cache[path] = cached
+    return cached[1]
+
+
+def save_preset(name, tuning):
+    """Write a tuning as a compact preset in the library"""
+    directory = preset_directory()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + PRESET_EXTENSION)
+    # Write to a temporary file first, the library may be read concurrently
+    partial = path + ".part"
+    with open(partial, 'w') as f:
+        json.dump({"version": 1, "tuning": tuning}, f,
+                  separators=(",", ":"), sort_keys=True)
+    os.replace(partial, path)
+
+
+def apply_tuning_to_objects(tuning, objects):
+    """Write a tuning to the active material of objects, once per material"""
+    dest_materials = collections.OrderedDict()
+    for obj in objects:
+        if obj.active_material is not None:
+            dest_materials.setdefault(obj.active_material, obj)
+    for mat in dest_materials:
+        setup_material_node_tree(mat)
+        write_tuning(mat, tuning)
+
+
+def apply_preset(name, objects):
+    """Apply a preset from the library to objects, for use in scripts"""
+    apply_tuning_to_objects(load_preset(name), objects)
+
+
+# Items of the preset enums, Blender needs Python to keep their strings alive
+_preset_items = []
+
+
+def preset_items(self, context):
+    _preset_items[:] = [(name, name, "") for name in list_presets()]
+    return _preset_items
+
+
+class SaveTuningPreset(bpy.types.Operator):
+    """Save the tuning of the active material to the preset library"""
+    bl_idname = "lfs.tuning_save_preset"
+    bl_label = "Save Preset"
+    bl_options = {"REGISTER"}
+
+    name = bpy.props.StringProperty(name="Name")
+
+    @classmethod
+    def poll(cls, context):
+        mat = context.object and context.object.active_material
+        return mat is not None and has_tuning_chain(mat)
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        name = bpy.path.clean_name(self.name)
+        if not name:
+            self.report({"ERROR"}, "Please enter a preset name")
+            return {"CANCELLED"}
+        save_preset(name, read_tuning(context.object.active_material))
+        return {"FINISHED"}
+
+
+class ApplyTuningPreset(bpy.types.Operator):
+    """Apply a tuning preset from the library"""
+    bl_idname = "lfs.tuning_apply_preset"
+    bl_label = "Apply Preset"
+    bl_options = {"REGISTER", "UNDO"}
+    bl_property = "preset"
+
+    preset = bpy.props.EnumProperty(name="Preset", items=preset_items)
+    to_pantin = bpy.props.BoolProperty()
+
+    @classmethod
+    def poll(cls, context):
+        return context.object is not None
+
+    def execute(self, context):
+        if not self.preset:
+            self.report({"ERROR"}, "No preset found")
+            return {"CANCELLED"}
+        dest_objects = target_objects(self, context)
+        if dest_objects is None:
+            return {"CANCELLED"}
+        if context.object not in dest_objects:
+            dest_objects = [context.object] + list(dest_objects)
+        apply_preset(self.preset, dest_objects)
+        return {"FINISHED"}
+
+
+class MaterialTuningPreferences(bpy.types.AddonPreferences):
+    bl_idname = __name__
+
+    preset_directory = bpy.props.StringProperty(
+        name="Preset Library",
+        description="Directory of the shared tuning presets",
+        subtype='DIR_PATH')
+
+    def draw(self, context):
+        self.layout.prop(self, "preset_directory")
+
+
+# Bake timings are appended to this file, one JSON line per bake
+BAKE_REPORT_FILE = '//textures/bake_report.jsonl'
+
+
+class BakeReport(StageReport):
+    """Time spent in each stage of a bake, per baked texture.
+
+    Stages are 'check', 'load', 'bake' and 'save-PNG'. Textures found up
+    to date only have a 'check' stage, and are listed in up_to_date.
+    """
+
+    def __init__(self, operation='bake'):
+        super().__init__(operation)
+        self.up_to_date = []
+
+    def as_dict(self):
+        report = super().as_dict()
+        report["up_to_date"] = self.up_to_date
+        return report
+
+
+# StageReport of the last bake, as a dict, drawn in the panel
+bake_report = {}
+
+
+def file_size(path):
+    path = bpy.path.abspath(path)
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def srgb_to_linear(rgb):
+    return np.where(rgb <= 0.04045, rgb / 12.92,
+                    np.power((np.maximum(rgb, 0.04045) + 0.055) / 1.055, 2.4))
+
+
+def linear_to_srgb(rgb):
+    return np.where(rgb <= 0.0031308, rgb * 12.92,
+                    1.055 * np.power(np.maximum(rgb, 0.0031308), 1.0 / 2.4) - 0.055)
+
+
+def pixel_bake_source(mat):
+    """Return the image a material's tuning chain can be applied to directly.
+
+    This is the case of shadeless materials whose only texture is an UV
+    mapped image replacing the diffuse color, and whose node tree is the
+    tuning chain. Return None if the material needs a render bake.
+    """
+    if not mat.use_shadeless:
+        return None
+    if not all(node_s["name"] in mat.node_tree.nodes for node_s in NODE_SETTINGS):
+        return None
+    slots = [slot for slot in mat.texture_slots
+             if slot is not None and slot.texture is not None and slot.use]
+    if len(slots) != 1:
+        return None
+    slot = slots[0]
+    tex = slot.texture
+    if (tex.type != 'IMAGE' or tex.image is None
+            or tex.use_color_ramp
+            or (tex.intensity, tex.contrast, tex.saturation) != (1.0, 1.0, 1.0)):
+        return None
+    if (slot.texture_coords != 'UV' or slot.blend_type != 'MIX'
+            or not slot.use_map_color_diffuse
+            or slot.diffuse_color_factor != 1.0):
+        return None
+    return tex.image
+
+
+def pixel_bake(pixels, params, srgb):
+    """Apply the tuning chain to source pixels, in linear space if they are sRGB"""
+    if srgb:
+        pixels = pixels.copy()
+        pixels[..., :3] = srgb_to_linear(pixels[..., :3])
+    pixels = apply_tuning(pixels, params)
+    if srgb:
+        pixels[..., :3] = linear_to_srgb(np.clip(pixels[..., :3], 0.0, None))
+    return np.clip(pixels, 0.0, 1.0)
+
+
+def bake_texture_name(obj, mat):
+    if "asset_uuid" in obj:
+        # find asset name
+        names = pantin_index(bpy.context.scene).names
+        if obj["asset_uuid"] in names:
+            return names[obj["asset_uuid"]] + '_' + mat.name
+    return obj.name + '_' + mat.name
+
+
+def render_bake(obj):
+    """Bake the full render of an object to the image of its UV faces"""
+    for sel_obj in bpy.context.selected_objects:
+        sel_obj.select = False
+    hide = obj.hide
+    hide_select = obj.hide_select
+    hide_render = obj.hide
+    # Fix for objects which have drivers on hide
+    # TODO same with keyframes
+    drivers = {}
+    if obj.animation_data and obj.animation_data.drivers:
+        for d_i, d in enumerate(obj.animation_data.drivers):
+            if d.data_path in ('hide', 'hide_select', 'hide_render'):
+                drivers[d_i] = d.mute
+                d.mute = True
+
+    obj.hide = False
+    obj.hide_select = False
+    obj.hide_render = False
+    obj.select = True
+    bpy.context.scene.objects.active = obj
+
+    print("Baking object %s..." % obj.name)
+    bpy.ops.object.bake_image('EXEC_DEFAULT')
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+
+    # Restore property states
+    obj.hide = hide
+    obj.hide_select = hide_select
+    obj.hide_render = hide_render
+    for d_i, d in drivers.items():
+        obj.animation_data.drivers[d_i].mute = d
+
+
+def baked_path(texture_name):
+    return '//textures/%s.png' % texture_name
+
+
+def image_file(img):
+    """Return the absolute path of the file of an image, or None.
+
+    Unlike img.size, this does not make Blender decode the image.
+    """
+    if img.source != 'FILE' or img.packed_file:
+        return None
+    path = os.path.normpath(bpy.path.abspath(img.filepath))
+    return path if os.path.isfile(path) else None
+
+
+def image_fingerprint(img):
+    """Return a hash of an image's content.
+
+    Images with a file are identified by its path, modification time and
+    size, without decoding them. The pixels of other images are hashed.
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps([img.source, img.colorspace_settings.name,
+                         img.use_alpha]).encode())
+    path = image_file(img)
+    if path is not None:
+        stat = os.stat(path)
+        h.update(json.dumps([path, stat.st_mtime_ns, stat.st_size]).encode())
+    elif img.size[0]:
+        h.update(json.dumps(list(img.size)).encode())
+        h.update(read_pixels(img).tobytes())
+    return h.hexdigest()
+
+
+def uv_fingerprint(obj):
+    """Return a hash of the active UV layout of a mesh object"""
+    uv_layer = obj.data.uv_layers.active
+    if uv_layer is None:
+        return None
+    uvs = np.empty(len(uv_layer.data) * 2, dtype=np.float32)
+    uv_layer.data.foreach_get("uv", uvs)
+    return hashlib.sha1(uvs.tobytes()).hexdigest()
+
+
+def bake_fingerprint(mat, images, obj=None):
+    """Return a hash of what a baked texture depends on.
+
+    That is the material's tuning, its source images and, for render
+    bakes, the UV layout of obj.
+    """
+    data = {"tuning": tuning_signature(read_tuning(mat)),
+            "images": [image_fingerprint(img) for img in images]}
+    if obj is not None:
+        data["uv"] = uv_fingerprint(obj)
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def material_images(mat):
+    """Return the images of the texture slots a material uses"""
+    return [slot.texture.image for slot in mat.texture_slots
+            if slot is not None and slot.use and slot.texture is not None
+            and slot.texture.type == 'IMAGE' and slot.texture.image is not None]
+
+
+def read_bake_fingerprint(texture_name):
+    """Return the fingerprint saved next to a baked PNG.
+
+    Return None if the PNG or its fingerprint is missing.
+    """
+    path = bpy.path.abspath(baked_path(texture_name))
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path + '.json') as f:
+            return json.load(f).get("fingerprint")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def write_bake_fingerprint(texture_name, fingerprint):
+    path = bpy.path.abspath(baked_path(texture_name))
+    with open(path + '.json', 'w') as f:
+        json.dump({"fingerprint": fingerprint}, f)
+
+
+def baked_image(texture_name, width, height):
+    """Return an image to bake texture_name to.
+
+    The image of a previous bake is reused, instead of adding a
+    duplicate datablock each time.
+    """
+    img = bpy.data.images.get(texture_name)
+    if img is None or img.filepath_raw != baked_path(texture_name):
+        return bpy.data.images.new(texture_name, width, height, alpha=True)
+    if tuple(img.size) != (width, height):
+        img.scale(width, height)
+    return img
+
+
+def baked_texture(texture_name, img):
+    """Return the texture of a baked image, reusing a previous one"""
+    new_texture = bpy.data.textures.get(texture_name)
+    if new_texture is None or new_texture.type != 'IMAGE':
+        new_texture = bpy.data.textures.new(texture_name, 'IMAGE')
+    new_texture.image = img
+    return new_texture
+
+
+def load_baked_texture(texture_name):
+    """Return a texture using the PNG of an up to date bake"""
+    img = bpy.data.images.get(texture_name)
+    if img is None or img.filepath_raw != baked_path(texture_name):
+        img = bpy.data.images.load(baked_path(texture_name),
+                                   check_existing=True)
+        img.name = texture_name
+    return baked_texture(texture_name, img)
+
+
+def check_bake(report, texture_name, mat, images, obj=None, force=False):
+    """Return the fingerprint of a bake, and a texture if it is up to date.
+
+    The texture uses the PNG of the previous bake, and is None when the
+    texture has to be baked again.
+    """
+    with report.stage(texture_name, 'check'):
+        fingerprint = bake_fingerprint(mat, images, obj)
+        if force or read_bake_fingerprint(texture_name) != fingerprint:
+            return fingerprint, None
+        new_texture = load_baked_texture(texture_name)
+    print("Texture %s is up to date" % texture_name)
+    report.up_to_date.append(texture_name)
+    return fingerprint, new_texture
+
+
+def save_baked_image(new_image, texture_name):
+    """Save a baked image and return a texture using it"""
+    new_image.file_format = 'PNG'
+    new_image.filepath_raw = baked_path(texture_name)
+    os.makedirs(bpy.path.abspath('//textures/'), exist_ok=True)
+    new_image.save()
+    return baked_texture(texture_name, new_image)
+
+
+def use_baked_texture(mat, new_texture):
+    """Replace the material's nodes with a baked texture"""
+    object_texture = mat.active_texture
+    mat.use_nodes = False
+    if object_texture is None:
+        tex_slot = mat.texture_slots.add()
+    else:
+        tex_slot = mat.texture_slots[0]
+    tex_slot.texture = new_texture
+
+
+def timed_pixel_bake(pixels, params, srgb):
+    """Run pixel_bake(), return its result and the seconds it took"""
+    start = time.perf_counter()
+    result = pixel_bake(pixels, params, srgb)
+    return result, time.perf_counter() - start
+
+
+def pixel_bake_all(jobs, workers=0, report=None, force=False):
+    """Bake materials from their source image pixels, in a thread pool.
+
+    jobs is a list of (material, source image, texture name) tuples.
+    Materials with the same source image and tuning signature share a
+    single baked image. Source pixels are read and results written on the
+    main thread, a few images at a time, while the tuning itself runs in
+    the pool. The stages of each texture are added to report, if given.
+    Textures whose fingerprint did not change are not baked again, unless
+    force is set.
+    """
+    if report is None:
+        report = BakeReport()
+    unique_jobs = collections.OrderedDict()
+    for mat, image, texture_name in jobs:
+        key = (image.name, tuning_signature(read_tuning(mat)))
+        if key not in unique_jobs:
+            unique_jobs[key] = (mat, image, texture_name, [])
+        unique_jobs[key][3].append(mat)
+    unique_jobs = list(unique_jobs.values())
+    print("Baking %d materials from %d unique tunings..." % (
+        len(jobs), len(unique_jobs)))
+    outdated_jobs = []
+    for mat, image, texture_name, materials in unique_jobs:
+        fingerprint, new_texture = check_bake(
+            report, texture_name, mat, [image], force=force)
+        if new_texture is None:
+            outdated_jobs.append(
+                (mat, image, texture_name, materials, fingerprint))
+            continue
+        for baked_mat in materials:
+            use_baked_texture(baked_mat, new_texture)
+
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for start in range(0, len(outdated_jobs), workers):
+            batch = outdated_jobs[start:start + workers]
+            futures = []
+            for mat, image, texture_name, materials, fingerprint in batch:
+                print("Baking material %s from pixels..." % mat.name)
+                srgb = (not image.is_float
+                        and image.colorspace_settings.name == 'sRGB')
+                with report.stage(texture_name, 'load'):
+                    pixels = read_pixels(image)
+                with report.stage(texture_name, 'bake'):
+                    params = tuning_parameters(mat)
+                # Source and baked pixels
+                report.add(texture_name, memory=2 * pixels.nbytes,
+                           bytes_read=file_size(image.filepath)
+                           if image.source == 'FILE' else 0)
+                futures.append(executor.submit(
+                    timed_pixel_bake, pixels, params, srgb))
+            for (mat, image, texture_name, materials, fingerprint), future \
+                    in zip(batch, futures):
+                pixels, seconds = future.result()
+                report.add(texture_name, 'bake', seconds)
+                with report.stage(texture_name, 'save-PNG'):
+                    new_image = baked_image(
+                        texture_name, image.size[0], image.size[1])
+                    write_pixels(new_image, pixels)
+                    new_texture = save_baked_image(new_image, texture_name)
+                    write_bake_fingerprint(texture_name, fingerprint)
+                report.add(texture_name,
+                           bytes_written=file_size(new_image.filepath_raw))
+                for baked_mat in materials:
+                    use_baked_texture(baked_mat, new_texture)
+
+
+def bake_all_textures(self, report=None, force=False):
+    """Bake the tuned materials of the scene to textures.
+
+    Textures are only baked again when the fingerprint saved next to
+    their PNG changed, or if force is set. The time spent on each texture
+    is added to report, if given, kept for the panel and logged to
+    BAKE_REPORT_FILE.
+    """
+    if report is None:
+        report = BakeReport()
     bpy.context.scene.render.bake_type = 'FULL'
     bpy.context.scene.render.use_bake_to_vertex_color = False
     bpy.context.scene.render.use_bake_selected_to_active = False
@@ -208,27 +1015,37 @@ def bake_all_textures(self):
                      for obj in bpy.context.scene.objects
                      if obj.active_material}
     # scene_materials = [obj.mat for obj in scene_objects]
+    pixel_jobs = []
+    pixel_materials = set()
     for obj, mat in scene_objects.items():
         if (mat.use_nodes
                 and 'Output' in mat.node_tree.nodes):  # vague test for BI mat
+            if mat.name in pixel_materials:
+                continue
+            texture_name = bake_texture_name(obj, mat)
+            source_image = pixel_bake_source(mat)
+            if source_image is not None and (image_file(source_image)
+                                             or source_image.size[0]):
+                pixel_jobs.append((mat, source_image, texture_name))
+                pixel_materials.add(mat.name)
+                continue
+
+            if obj.data.uv_textures.active is not None:
+                fingerprint, new_texture = check_bake(
+                    report, texture_name, mat, material_images(mat), obj,
+                    force)
+                if new_texture is not None:
+                    use_baked_texture(mat, new_texture)
+                    continue
             object_texture = mat.active_texture
-            if "asset_uuid" in obj:
-                # find asset name
-                for item in bpy.context.scene.imported_items:
-                    if item.asset_uuid == obj["asset_uuid"]:
-                        break
-                texture_name = item.name + '_' + mat.name
-            else:
-                texture_name = obj.name + '_' + mat.name
             if object_texture is None:
                 # object_texture = bpy.data.textures.new(texture_name, 'IMAGE')
-                new_image = bpy.data.images.new(
-                    texture_name, 1024, 1024, alpha=True)
+                new_image = baked_image(texture_name, 1024, 1024)
             else:
                 existing_image = object_texture.image
-                new_image = bpy.data.images.new(
+                new_image = baked_image(
                     texture_name, existing_image.size[0],
-                    existing_image.size[1], alpha=True)
+                    existing_image.size[1])
             if obj.data.uv_textures.active is not None:
                 for uv_face in obj.data.uv_textures.active.data:
                     uv_face.image = new_image
@@ -238,53 +1055,25 @@ def bake_all_textures(self):
                     "Could not bake object %s: no UV map" % obj.name)
                 continue
 
-            # bake
-            for sel_obj in bpy.context.selected_objects:
-                sel_obj.select = False
-            hide = obj.hide
-            hide_select = obj.hide_select
-            hide_render = obj.hide
-            # Fix for objects which have drivers on hide
-            # TODO same with keyframes
-            drivers = {}
-            if obj.animation_data and obj.animation_data.drivers:
-                for d_i, d in enumerate(obj.animation_data.drivers):
-                    if d.data_path in ('hide', 'hide_select', 'hide_render'):
-                        drivers[d_i] = d.mute
-                        d.mute = True
-
-            obj.hide = False
-            obj.hide_select = False
-            obj.hide_render = False
-            obj.select = True
-            bpy.context.scene.objects.active = obj
-
-            print("Baking object %s..." % obj.name)
-            bpy.ops.object.bake_image('EXEC_DEFAULT')
-
-            bpy.ops.object.mode_set(mode='OBJECT')
-
-            # Restore property states
-            obj.hide = hide
-            obj.hide_select = hide_select
-            obj.hide_render = hide_render
-            for d_i, d in drivers.items():
-                obj.animation_data.drivers[d_i].mute = d
-
-            new_image.file_format = 'PNG'
-            new_image.filepath_raw = ('//textures/%s.png' % texture_name)
-            os.makedirs(bpy.path.abspath('//textures/'), exist_ok=True)
-            new_image.save()
-
-            mat.use_nodes = False
-            if object_texture is None:
-                tex_slot = mat.texture_slots.add()
-            else:
-                tex_slot = mat.texture_slots[0]
-            new_texture = bpy.data.textures.new(texture_name, 'IMAGE')
-            new_texture.image = new_image
-            tex_slot.texture = new_texture
+            report.add(texture_name, memory=image_memory(*new_image.size))
+            with report.stage(texture_name, 'bake'):
+                render_bake(obj)
+            with report.stage(texture_name, 'save-PNG'):
+                new_texture = save_baked_image(new_image, texture_name)
+                write_bake_fingerprint(texture_name, fingerprint)
+            report.add(texture_name,
+                       bytes_written=file_size(new_image.filepath_raw))
+            use_baked_texture(mat, new_texture)
 
+    pixel_bake_all(pixel_jobs, report=report, force=force)
+
+    report.finish()
+    bake_report.clear()
+    bake_report.update(report.as_dict())
+    try:
+        write_report(bake_report, bpy.path.abspath(BAKE_REPORT_FILE))
+    except OSError as e:
+        self.report({"WARNING"}, "Could not write bake report: %s" % e)
     print("Done baking.")
 
 
@@ -294,18 +1083,22 @@ class BakeAllTextures(bpy.types.Operator):
     bl_label = "Bake All Textures"
     bl_options = {"REGISTER"}
 
+    force = bpy.props.BoolProperty(
+        name="Force",
+        description="Also bake the textures which are up to date")
+
     @classmethod
     def poll(cls, context):
         return bpy.data.filepath
 
     def execute(self, context):
-        bake_all_textures(self)
+        bake_all_textures(self, force=self.force)
         return {"FINISHED"}
 
 
-def reset_all():
-    """Reset all fields to their default values"""
-    nodes = bpy.context.object.active_material.node_tree.nodes
+def reset_material(mat):
+    """Reset all fields of a material to their default values"""
+    nodes = mat.node_tree.nodes
     for node_s in NODE_SETTINGS:
         node = nodes[node_s["name"]]
         if "default_values" in node_s:
@@ -313,7 +1106,6 @@ def reset_all():
                 node.inputs[input_socket].default_value = value
         # Hack for curves
         if node.type == "CURVE_RGB":
-            print(node)
             node.mapping.use_clip = True
             node.mapping.clip_max_x = 1.0
             node.mapping.clip_max_y = 1.0
@@ -321,10 +1113,8 @@ def reset_all():
             node.mapping.clip_min_y = 0.0
 
             for curve in node.mapping.curves:
-                print(curve)
                 while len(curve.points) > 2:
                     curve.points.remove(curve.points[1])
-                    print(len(curve.points))
                 curve.points[0].location = [0.0, 0.0]
                 curve.points[0].handle_type = 'AUTO'
                 curve.points[1].location = [1.0, 1.0]
@@ -334,6 +1124,11 @@ def reset_all():
             node.mapping.update()
 
 
+def reset_all():
+    """Reset all fields to their default values"""
+    reset_material(bpy.context.object.active_material)
+
+
 class ResetAll(bpy.types.Operator):
     """Bake all textures to directory"""
     bl_idname = "lfs.tuning_reset_all"
@@ -349,6 +1144,360 @@ class ResetAll(bpy.types.Operator):
         return {"FINISHED"}
 
 
+# Largest width and height of the pixels tuned by the live preview
+PREVIEW_SIZE = 128
+
+# Seconds without edits before the live preview is written to the nodes
+PREVIEW_COMMIT_DELAY = 0.5
+
+# Name of the image and texture showing the live preview
+PREVIEW_NAME = "Tuning Preview"
+
+# Preview settings standing for node inputs: (node name, input) -> property
+PREVIEW_PROPS = collections.OrderedDict([
+    (("Gamma", "Gamma"), "gamma"),
+    (("Hue Saturation Value", "Hue"), "hue"),
+    (("Hue Saturation Value", "Saturation"), "saturation"),
+    (("Hue Saturation Value", "Value"), "value"),
+    (("Mix", "Color2"), "color"),
+    (("Mix", "Fac"), "fac"),
+])
+
+# State of the live preview: material name, downsampled source pixels,
+# whether to render it again and the time of the last uncommitted edit
+_preview = {}
+
+
+def preview_changed(self, context):
+    if _preview:
+        _preview["render"] = True
+        _preview["edited"] = time.time()
+
+
+class TuningPreviewSettings(bpy.types.PropertyGroup):
+    """Tuning values edited in live preview, before they go to the nodes"""
+    gamma = bpy.props.FloatProperty(
+        name="Gamma", min=0.001, soft_max=10.0, default=1.0,
+        update=preview_changed)
+    hue = bpy.props.FloatProperty(
+        name="Hue", min=0.0, max=1.0, default=0.5, update=preview_changed)
+    saturation = bpy.props.FloatProperty(
+        name="Saturation", min=0.0, soft_max=2.0, default=1.0,
+        update=preview_changed)
+    value = bpy.props.FloatProperty(
+        name="Value", min=0.0, soft_max=2.0, default=1.0,
+        update=preview_changed)
+    color = bpy.props.FloatVectorProperty(
+        name="Color2", subtype='COLOR', size=4, min=0.0, max=1.0,
+        default=(0.5, 0.5, 0.5, 1.0), update=preview_changed)
+    fac = bpy.props.FloatProperty(
+        name="Fac", min=0.0, max=1.0, default=1.0, update=preview_changed)
+
+
+def downsample(pixels, size):
+    """Average blocks of a (height, width, 4) array to fit in size pixels"""
+    height, width = pixels.shape[:2]
+    step = max(1, -(-max(width, height) // size))
+    height, width = max(1, height // step), max(1, width // step)
+    pixels = pixels[:height * step, :width * step]
+    return pixels.reshape(height, step, width, step, 4).mean(axis=(1, 3),
+                                                            dtype=np.float32)
+
+
+def preview_source(mat):
+    """Return the image the live preview of a material is made from"""
+    image = pixel_bake_source(mat)
+    if image is None:
+        tex = mat.active_texture
+        if tex is not None and tex.type == 'IMAGE':
+            image = tex.image
+    return image
+
+
+def is_previewing(mat):
+    return bool(_preview) and mat is not None and _preview["material"] == mat.name
+
+
+def start_preview(context):
+    """Cache the downsampled pixels of the active material and show them.
+
+    Return False if the material has no image to preview.
+    """
+    mat = context.object.active_material
+    image = preview_source(mat)
+    if image is None or not image.size[0]:
+        return False
+    stop_preview(context)
+
+    settings = context.window_manager.tuning_preview
+    nodes = mat.node_tree.nodes
+    for (node_name, input_name), prop in PREVIEW_PROPS.items():
+        setattr(settings, prop, nodes[node_name].inputs[input_name].default_value)
+
+    pixels = downsample(read_pixels(image), PREVIEW_SIZE)
+    preview_image = bpy.data.images.get(PREVIEW_NAME)
+    if (preview_image is None
+            or tuple(preview_image.size) != (pixels.shape[1], pixels.shape[0])):
+        if preview_image is not None:
+            bpy.data.images.remove(preview_image)
+        preview_image = bpy.data.images.new(
+            PREVIEW_NAME, pixels.shape[1], pixels.shape[0], alpha=True)
+    texture = bpy.data.textures.get(PREVIEW_NAME)
+    if texture is None:
+        texture = bpy.data.textures.new(PREVIEW_NAME, 'IMAGE')
+    texture.image = preview_image
+
+    _preview.update(
+        material=mat.name, pixels=pixels, render=True, edited=None,
+        srgb=not image.is_float and image.colorspace_settings.name == 'sRGB')
+    render_preview(context)
+    return True
+
+
+def render_preview(context):
+    """Apply the preview settings to the cached pixels"""
+    mat = bpy.data.materials[_preview["material"]]
+    settings = context.window_manager.tuning_preview
+    params = {
+        "gamma": settings.gamma,
+        "hue": settings.hue,
+        "saturation": settings.saturation,
+        "value": settings.value,
+        # Curves are edited on the node itself
+        "curves": curve_lookup_tables(mat.node_tree.nodes["RGB Curves"]),
+        "color": tuple(settings.color),
+        "fac": settings.fac,
+    }
+    preview_image = bpy.data.images[PREVIEW_NAME]
+    write_pixels(preview_image, pixel_bake(_preview["pixels"], params,
+                                           _preview["srgb"]))
+    preview_image.update()
+    bpy.data.textures[PREVIEW_NAME].update_tag()
+    _preview["render"] = False
+    if context.screen is not None:
+        for area in context.screen.areas:
+            if area.type == 'PROPERTIES':
+                area.tag_redraw()
+
+
+def commit_preview(context):
+    """Write the preview settings to the nodes of the previewed material"""
+    mat = bpy.data.materials.get(_preview["material"])
+    if mat is not None:
+        settings = context.window_manager.tuning_preview
+        nodes = mat.node_tree.nodes
+        for (node_name, input_name), prop in PREVIEW_PROPS.items():
+            socket = nodes[node_name].inputs[input_name]
+            value = _plain(getattr(settings, prop))
+            # Only changed inputs, each one updates the material
+            if _plain(socket.default_value) != value:
+                socket.default_value = value
+    _preview["edited"] = None
+
+
+def stop_preview(context):
+    """Commit pending edits and leave live preview"""
+    if _preview:
+        if _preview["edited"] is not None:
+            commit_preview(context)
+        _preview.clear()
+
+
+@bpy.app.handlers.persistent
+def clear_tuning_preview(dummy):
+    # Datablocks are replaced, pixels and pending edits are dropped
+    _preview.clear()
+
+
+@bpy.app.handlers.persistent
+def update_tuning_preview(scene):
+    """Render and commit the live preview, coalescing rapid edits.
+
+    Edits arriving between two scene updates are rendered once, and
+    written to the nodes once no edit came for PREVIEW_COMMIT_DELAY.
+    """
+    if not _preview:
+        return
+    context = bpy.context
+    if context.object is None or not is_previewing(context.object.active_material):
+        stop_preview(context)
+        return
+    if _preview["render"]:
+        render_preview(context)
+    edited = _preview["edited"]
+    if edited is not None and time.time() - edited >= PREVIEW_COMMIT_DELAY:
+        commit_preview(context)
+
+
+class StartTuningPreview(bpy.types.Operator):
+    """Tune a downsampled copy of the texture, and only update the material when edits pause"""
+    bl_idname = "lfs.tuning_start_preview"
+    bl_label = "Live Preview"
+    bl_options = {"REGISTER"}
+
+    @classmethod
+    def poll(cls, context):
+        mat = context.object and context.object.active_material
+        return mat is not None and has_tuning_chain(mat)
+
+    def execute(self, context):
+        if not start_preview(context):
+            self.report({"ERROR"}, "Material has no image texture to preview")
+            return {"CANCELLED"}
+        return {"FINISHED"}
+
+
+class StopTuningPreview(bpy.types.Operator):
+    """Write the tuning to the material and leave live preview"""
+    bl_idname = "lfs.tuning_stop_preview"
+    bl_label = "Apply Preview"
+    bl_options = {"REGISTER", "UNDO"}
+
+    def execute(self, context):
+        stop_preview(context)
+        return {"FINISHED"}
+
+
+class MaterialIndex:
+    """Materials used in a scene, with the objects and slots using them.
+
+    Built in a single pass over the scene objects, so that bulk operations
+    do not scan bpy.data again for every object or material.
+    """
+
+    def __init__(self, scene):
+        # material -> list of (object, slot index)
+        self.users = collections.OrderedDict()
+        for obj in scene.objects:
+            for slot_index, slot in enumerate(obj.material_slots):
+                if slot.material is not None:
+                    self.users.setdefault(slot.material, []).append(
+                        (obj, slot_index))
+
+    def materials(self, group="", asset_uuid="", name_pattern="",
+                  tuned_only=False):
+        """Return the materials matching all the given filters.
+
+        group keeps materials used by an object of this group, asset_uuid
+        those used by an object of this pantin, and name_pattern is a
+        shell-style pattern on the material name.
+        """
+        group_objects = None
+        if group:
+            group_objects = set(bpy.data.groups[group].objects)
+        result = []
+        for mat, users in self.users.items():
+            if mat.library is not None:
+                continue
+            if name_pattern and not fnmatch.fnmatchcase(mat.name, name_pattern):
+                continue
+            if tuned_only and not is_tuned(mat):
+                continue
+            if group_objects is not None and not any(
+                    obj in group_objects for obj, slot_index in users):
+                continue
+            if asset_uuid and not any(
+                    obj.get("asset_uuid") == asset_uuid for obj, slot_index in users):
+                continue
+            result.append(mat)
+        return result
+
+
+# scene name -> MaterialIndex, dropped when objects or materials change,
+# like pantin indices
+_material_indices = {}
+
+
+def material_index(scene):
+    """Return the material index of a scene, building it if needed"""
+    if scene.name not in _material_indices:
+        _material_indices[scene.name] = MaterialIndex(scene)
+    return _material_indices[scene.name]
+
+
+@bpy.app.handlers.persistent
+def clear_scene_indices(dummy):
+    _material_indices.clear()
+    _pantin_indices.clear()
+
+
+@bpy.app.handlers.persistent
+def update_scene_indices(scene):
+    # This runs after every scene update, only drop the indices on changes
+    if bpy.data.objects.is_updated or bpy.data.materials.is_updated:
+        _material_indices.clear()
+        _pantin_indices.clear()
+
+
+class BulkTuning(bpy.types.Operator):
+    """Set up, reset or apply tuning to all the scene materials matching filters"""
+    bl_idname = "lfs.tuning_bulk"
+    bl_label = "Bulk Tuning"
+    bl_options = {"REGISTER", "UNDO"}
+
+    action = bpy.props.EnumProperty(
+        name="Action",
+        items=[("SETUP", "Setup Node Tree", "Create the missing tuning nodes"),
+               ("RESET", "Reset", "Reset tuning to default values"),
+               ("COPY", "Copy Active", "Copy the tuning of the active material"),
+               ("PRESET", "Apply Preset", "Apply a tuning preset")])
+    preset = bpy.props.EnumProperty(name="Preset", items=preset_items)
+    group = bpy.props.StringProperty(
+        name="Group", description="Only materials of objects in this group")
+    asset_uuid = bpy.props.StringProperty(
+        name="Pantin UUID",
+        description="Only materials of objects in the pantin with this uuid")
+    name_pattern = bpy.props.StringProperty(
+        name="Name Pattern",
+        description="Only materials whose name matches this pattern, eg. 'skin_*'")
+
+    def invoke(self, context, event):
+        if context.object is not None and "asset_uuid" in context.object:
+            self.asset_uuid = context.object["asset_uuid"]
+        return context.window_manager.invoke_props_dialog(self)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "action")
+        if self.action == "PRESET":
+            layout.prop(self, "preset")
+        layout.prop_search(self, "group", bpy.data, "groups")
+        layout.prop(self, "asset_uuid")
+        layout.prop(self, "name_pattern")
+
+    def execute(self, context):
+        if self.group and self.group not in bpy.data.groups:
+            self.report({"ERROR"}, "Group %s not found" % self.group)
+            return {"CANCELLED"}
+        materials = material_index(context.scene).materials(
+            group=self.group, asset_uuid=self.asset_uuid,
+            name_pattern=self.name_pattern,
+            tuned_only=self.action == "RESET")
+
+        if self.action == "COPY":
+            source = context.object and context.object.active_material
+            if source is None or not has_tuning_chain(source):
+                self.report({"ERROR"}, "Active material has no tuning")
+                return {"CANCELLED"}
+            tuning = read_tuning(source)
+        elif self.action == "PRESET":
+            if not self.preset:
+                self.report({"ERROR"}, "No preset found")
+                return {"CANCELLED"}
+            tuning = load_preset(self.preset)
+
+        for mat in materials:
+            # Partly set up trees are completed first
+            setup_material_node_tree(mat)
+            if self.action == "RESET":
+                reset_material(mat)
+            elif self.action in {"COPY", "PRESET"}:
+                write_tuning(mat, tuning)
+
+        self.report({"INFO"}, "Processed %d materials" % len(materials))
+        return {"FINISHED"}
+
+
 class MaterialTuningPanel(bpy.types.Panel):
     bl_idname = "material_tuning_panel"
     bl_label = "Material Tuning"
@@ -371,14 +1520,27 @@ class MaterialTuningPanel(bpy.types.Panel):
                     and 'Hue Saturation Value'
                     in context.material.node_tree.nodes):
 
+                previewing = is_previewing(context.material)
+                settings = context.window_manager.tuning_preview
                 col = layout.column(align=True)
                 col.operator('lfs.tuning_reset_all')
+                col.operator('lfs.tuning_bulk')
+                if previewing:
+                    col.operator('lfs.tuning_stop_preview')
+                    layout.template_preview(bpy.data.textures[PREVIEW_NAME],
+                                            show_buttons=False)
+                else:
+                    col.operator('lfs.tuning_start_preview')
                 col.separator()
                 for node_s in NODE_SETTINGS:
                     col = layout.column(align=True)
                     node = context.material.node_tree.nodes[node_s["name"]]
                     for prop in node_s["inputs"]:
-                        col.prop(node.inputs[prop], "default_value", text=prop)
+                        if previewing and (node_s["name"], prop) in PREVIEW_PROPS:
+                            col.prop(settings, PREVIEW_PROPS[node_s["name"], prop],
+                                     text=prop)
+                        else:
+                            col.prop(node.inputs[prop], "default_value", text=prop)
 
                     col.context_pointer_set("node", node)
 
@@ -396,6 +1558,11 @@ class MaterialTuningPanel(bpy.types.Panel):
                 if 'import_pantin_from_lib' in bpy.context.user_preferences.addons:
                     col.operator('lfs.tuning_copy_to_selected',
                                  text="Copy To Pantin").to_pantin = True
+                col.separator()
+                row = col.row(align=True)
+                row.operator_menu_enum('lfs.tuning_apply_preset', 'preset',
+                                       text="Apply Preset")
+                row.operator('lfs.tuning_save_preset', text="", icon='ZOOMIN')
                 # col = layout.column()
                 # if not bpy.data.filepath:
                 #     col.label(icon='ERROR', text='Please save file first')
@@ -403,13 +1570,47 @@ class MaterialTuningPanel(bpy.types.Panel):
             else:
                 col = layout.column()
                 col.operator('lfs.tuning_setup_node_tree')
+                col.operator('lfs.tuning_setup_all_node_trees')
+
+        if bake_report:
+            col = layout.box().column(align=True)
+            col.label("Last bake: %d textures in %.1f s, %d up to date" % (
+                len(bake_report["items"]), bake_report["seconds"],
+                len(bake_report["up_to_date"])))
+            totals = stage_totals(bake_report)
+            if totals:
+                col.label(", ".join("%s %.1f s" % (stage, seconds)
+                                    for stage, seconds in totals.items()))
+            for name, item in slowest_items(bake_report):
+                col.label("%s: %.1f s, %.0f MB" % (
+                    name, sum(item["stages"].values()),
+                    item["peak_memory"] / (1 << 20)))
 
 
 def register():
     bpy.utils.register_module(__name__)
+    bpy.types.WindowManager.tuning_preview = bpy.props.PointerProperty(
+        type=TuningPreviewSettings)
+    bpy.app.handlers.load_post.append(clear_scene_indices)
+    bpy.app.handlers.undo_post.append(clear_scene_indices)
+    bpy.app.handlers.redo_post.append(clear_scene_indices)
+    bpy.app.handlers.scene_update_post.append(update_scene_indices)
+    bpy.app.handlers.load_post.append(clear_tuning_preview)
+    bpy.app.handlers.undo_post.append(clear_tuning_preview)
+    bpy.app.handlers.redo_post.append(clear_tuning_preview)
+    bpy.app.handlers.scene_update_post.append(update_tuning_preview)
 
 
 def unregister():
+    bpy.app.handlers.load_post.remove(clear_scene_indices)
+    bpy.app.handlers.undo_post.remove(clear_scene_indices)
+    bpy.app.handlers.redo_post.remove(clear_scene_indices)
+    bpy.app.handlers.scene_update_post.remove(update_scene_indices)
+    bpy.app.handlers.load_post.remove(clear_tuning_preview)
+    bpy.app.handlers.undo_post.remove(clear_tuning_preview)
+    bpy.app.handlers.redo_post.remove(clear_tuning_preview)
+    bpy.app.handlers.scene_update_post.remove(update_tuning_preview)
+    del bpy.types.WindowManager.tuning_preview
     bpy.utils.unregister_module(__name__)
 
 
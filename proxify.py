@@ -29,22 +29,998 @@ bl_info = {
     }
 
 import bpy
+from bpy_extras.object_utils import world_to_camera_view
+from mathutils import Vector
 import os
+import sys
+import json
+import argparse
+import collections
+import zlib
+import struct
+import uuid
+import hashlib
+import time
+import tempfile
+import subprocess
+import concurrent.futures
+import numpy as np
 
-def proxify(img):
-    if 'is_proxy' in img:# and img['is_proxy'] == True:
-        if img['is_proxy'] and img.size[0] != bpy.context.scene.proxy_destination:
-#            print(img)
-#            print(img['original'])
-            original = bpy.data.images[img['original']]
-            deproxify(img)
-
-            proxify(img)
-        else:
+if __name__ == "__main__":
+    # Run as a script, by worker processes
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stage_report import (StageReport, stage_totals, slowest_items,
+                          write_report, image_memory)
+
+# Blender file formats to encode proxies with, by file extension
+EXTENSION_FORMATS = {
+    '.png': 'PNG',
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.tga': 'TARGA',
+    '.tif': 'TIFF',
+    '.tiff': 'TIFF',
+    '.exr': 'OPEN_EXR',
+    '.bmp': 'BMP',
+}
+
+# Image settings proxies are written with, by file format: 8 bit for
+# integer formats, half float for EXR, with compression
+PROXY_IMAGE_SETTINGS = {
+    'PNG': {'color_mode': 'RGBA', 'color_depth': '8', 'compression': 90},
+    'JPEG': {'color_mode': 'RGB', 'quality': 90},
+    'TARGA': {'color_mode': 'RGBA'},
+    'TIFF': {'color_mode': 'RGBA', 'color_depth': '8', 'tiff_codec': 'DEFLATE'},
+    'OPEN_EXR': {'color_mode': 'RGBA', 'color_depth': '16', 'exr_codec': 'ZIP'},
+    'BMP': {'color_mode': 'RGB'},
+}
+
+# Proxy file extensions, by scene.proxy_format
+PROXY_FORMAT_EXTENSIONS = {
+    'PNG': '.png',
+    'JPEG': '.jpg',
+    'OPEN_EXR': '.exr',
+}
+
+# Extensions of float images, which get half float EXR proxies
+FLOAT_EXTENSIONS = {'.exr', '.hdr'}
+
+# Color spaces of images holding data rather than colors
+DATA_COLORSPACES = {'Non-Color', 'Raw', 'Linear'}
+
+
+def _png_info(f):
+    header = f.read(26)
+    if header[:8] != b'\x89PNG\r\n\x1a\n' or header[12:16] != b'IHDR':
+        return None
+    width, height, depth, color_type = struct.unpack('>IIBB', header[16:26])
+    if color_type == 3:  # palette entries are 8 bit
+        depth = 8
+    return width, height, {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(color_type, 4), depth
+
+
+def _jpeg_info(f):
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff':
+            byte = f.read(1)
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0xd8 or marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            continue
+        length = struct.unpack('>H', f.read(2))[0]
+        # Start of frame markers, except DHT, JPG and DAC
+        if 0xc0 <= marker <= 0xcf and marker not in {0xc4, 0xc8, 0xcc}:
+            precision, height, width, channels = struct.unpack('>BHHB', f.read(6))
+            return width, height, channels, precision
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def _exr_info(f):
+    if f.read(8)[:4] != b'\x76\x2f\x31\x01':
+        return None
+    width = height = None
+    channels = 0
+    depth = 16
+
+    def read_string():
+        chars = bytearray()
+        char = f.read(1)
+        while char and char != b'\x00':
+            chars += char
+            char = f.read(1)
+        return chars.decode('latin-1')
+
+    while True:
+        name = read_string()
+        if not name:
+            break
+        read_string()  # type
+        size = struct.unpack('<i', f.read(4))[0]
+        value = f.read(size)
+        if name == 'dataWindow':
+            xmin, ymin, xmax, ymax = struct.unpack('<iiii', value[:16])
+            width, height = xmax - xmin + 1, ymax - ymin + 1
+        elif name == 'channels':
+            # Null-terminated names, each followed by 16 bytes of settings
+            offset = 0
+            while offset < len(value) and value[offset] != 0:
+                offset = value.index(b'\x00', offset) + 1
+                # Pixel types are unsigned int, half and float
+                if struct.unpack_from('<i', value, offset)[0] != 1:
+                    depth = 32
+                offset += 16
+                channels += 1
+    if width is None:
+        return None
+    return width, height, channels, depth
+
+
+def _tiff_info(f):
+    order = f.read(2)
+    if order not in {b'II', b'MM'}:
+        return None
+    order = '<' if order == b'II' else '>'
+    magic, offset = struct.unpack(order + 'HI', f.read(6))
+    if magic != 42:
+        return None
+    f.seek(offset)
+    tags = {}
+    count = struct.unpack(order + 'H', f.read(2))[0]
+    for i in range(count):
+        tag, type, number, value = struct.unpack(order + 'HHI4s', f.read(12))
+        if tag in {256, 257, 277}:
+            # SHORT values are left-justified in the value field
+            fmt = order + ('H' if type == 3 else 'I')
+            tags[tag] = struct.unpack_from(fmt, value)[0]
+        elif tag == 258:
+            # Bits of each sample, stored elsewhere if they do not fit
+            if number > 2:
+                position = f.tell()
+                f.seek(struct.unpack(order + 'I', value)[0])
+                value = f.read(2)
+                f.seek(position)
+            tags[tag] = struct.unpack_from(order + 'H', value)[0]
+    if 256 not in tags or 257 not in tags:
+        return None
+    return tags[256], tags[257], tags.get(277, 1), tags.get(258, 1)
+
+
+IMAGE_INFO_READERS = {
+    '.png': _png_info,
+    '.jpg': _jpeg_info,
+    '.jpeg': _jpeg_info,
+    '.exr': _exr_info,
+    '.tif': _tiff_info,
+    '.tiff': _tiff_info,
+}
+
+# (path, mtime, size) -> (width, height, channels, depth)
+_image_info_cache = {}
+
+
+def image_file_info(filepath):
+    """Return (width, height, channels, depth) of an image file, reading only its header.
+
+    depth is the number of bits of each channel.
+
+    Return None for unsupported or unreadable files.
+    """
+    reader = IMAGE_INFO_READERS.get(os.path.splitext(filepath)[1].lower())
+    if reader is None:
+        return None
+    try:
+        stat = os.stat(filepath)
+        key = (filepath, stat.st_mtime_ns, stat.st_size)
+        if key not in _image_info_cache:
+            with open(filepath, 'rb') as f:
+                _image_info_cache[key] = reader(f)
+        return _image_info_cache[key]
+    except (OSError, struct.error, ValueError):
+        return None
+
+
+def image_width(img):
+    """Return the width of img, without decoding its pixels when possible"""
+    if img.source == 'FILE' and not img.has_data and not img.packed_file:
+        info = image_file_info(bpy.path.abspath(img.filepath))
+        if info is not None:
+            return info[0]
+    return img.size[0]
+
+
+# Bytes of PNG scanlines decoded at once, the Average and Paeth filters
+# are undone for a whole strip of rows at a time
+PNG_STRIP_BYTES = 16 << 20
+
+
+def _unfilter_png_row(filter_type, row, previous, bpp):
+    """Undo a None, Sub or Up filter of a PNG scanline, given the previous unfiltered one"""
+    if filter_type == 0:
+        return row
+    if filter_type == 1:
+        # Sub: running sum of each byte of the pixels, modulo 256
+        return np.cumsum(row.reshape(-1, bpp), axis=0, dtype=np.uint8).ravel()
+    if filter_type == 2:
+        return row + previous
+    raise ValueError("Invalid PNG filter type {}".format(filter_type))
+
+
+def _unfilter_png_strip(filter_types, rows, previous, bpp):
+    """Undo the filters of consecutive PNG scanlines.
+
+    rows is a (count, width * bpp) array of filtered scanlines, previous
+    the unfiltered scanline above them. Average and Paeth filters depend
+    on the byte just decoded on the left, so they cannot be undone along
+    a row at once. The strip is skewed instead, each row one pixel right
+    of the row above: a column of the skewed strip then only depends on
+    the previous columns, and is undone for all rows at once.
+    """
+    if max(filter_types) > 4:
+        raise ValueError("Invalid PNG filter type {}".format(max(filter_types)))
+    if max(filter_types) <= 2:
+        out = np.empty_like(rows)
+        for i, filter_type in enumerate(filter_types):
+            previous = out[i] = _unfilter_png_row(filter_type, rows[i], previous, bpp)
+        return out
+    count = len(rows)
+    width = rows.shape[1] // bpp
+    # Pixel x of row y, previous being row 0, goes to column x + y + 1,
+    # so pixels left of x = 0 are zeros. Columns come first, to be
+    # contiguous.
+    shape = (width + count + 1, count + 1, bpp)
+    filtered = np.zeros(shape, dtype=np.int16)
+    decoded = np.zeros(shape, dtype=np.int16)
+    decoded[1:width + 1, 0] = previous.reshape(width, bpp)
+    for y in range(1, count + 1):
+        filtered[y + 1:y + width + 1, y] = rows[y - 1].reshape(width, bpp)
+    filter_types = np.asarray(filter_types)[:, None]
+    use_left = (filter_types == 1).astype(np.int16)
+    use_up = (filter_types == 2).astype(np.int16)
+    use_average = filter_types == 3
+    use_paeth = filter_types == 4
+    for column in range(2, width + count + 1):
+        first = max(1, column - width)
+        last = min(count, column - 1) + 1
+        left = decoded[column - 1, first:last]
+        up = decoded[column - 1, first - 1:last - 1]
+        up_left = decoded[column - 2, first - 1:last - 1]
+        from_left = up - up_left
+        from_up = left - up_left
+        distance_left = np.abs(from_left)
+        distance_up = np.abs(from_up)
+        distance_up_left = np.abs(from_left + from_up)
+        paeth = np.where((distance_left <= distance_up) & (distance_left <= distance_up_left),
+                         left, np.where(distance_up <= distance_up_left, up, up_left))
+        types = slice(first - 1, last - 1)
+        predictor = np.where(use_average[types], (left + up) >> 1,
+                             left * use_left[types] + up * use_up[types])
+        predictor = np.where(use_paeth[types], paeth, predictor)
+        decoded[column, first:last] = (filtered[column, first:last] + predictor) & 0xff
+    out = np.empty_like(rows)
+    for y in range(1, count + 1):
+        out[y - 1] = decoded[y + 1:y + width + 1, y].ravel()
+    return out
+
+
+def iter_png_rows(filepath, chunk_size=1 << 20):
+    """Decode a PNG file one scanline at a time.
+
+    Yield a (width, height, channels, depth) header first, then each row as
+    a (width, channels) array. Rows are decoded in strips of about
+    PNG_STRIP_BYTES. Only 8 and 16 bit, non interlaced images are
+    supported, ValueError is raised for others.
+    """
+    with open(filepath, 'rb') as f:
+        if f.read(8) != b'\x89PNG\r\n\x1a\n':
+            raise ValueError("Not a PNG file")
+        decompressor = zlib.decompressobj()
+        palette = None
+        alpha = None
+        pending = bytearray()
+        previous = None
+        started = False
+        rows = 0
+
+        def pixels(row):
+            if depth == 16:
+                row = row.view('>u2').reshape(width, -1)
+            else:
+                row = row.reshape(width, -1)
+            if color_type != 3:
+                return row
+            indices = row[:, 0]
+            row = palette[indices]
+            if alpha is not None:
+                full_alpha = np.full(len(palette), 255, dtype=np.uint8)
+                full_alpha[:len(alpha)] = alpha
+                row = np.column_stack((row, full_alpha[indices]))
+            return row
+
+        while True:
+            length, chunk_type = struct.unpack('>I4s', f.read(8))
+            if chunk_type == b'IHDR':
+                data = f.read(length)
+                width, height, depth, color_type, compression, filter_method, \
+                    interlace = struct.unpack('>IIBBBBB', data)
+                if depth not in {8, 16} or interlace:
+                    raise ValueError("Unsupported PNG depth or interlacing")
+                channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+                bpp = channels * depth // 8
+                stride = width * bpp + 1
+                strip_rows = max(1, PNG_STRIP_BYTES // stride)
+                previous = np.zeros(width * bpp, dtype=np.uint8)
+            elif chunk_type == b'PLTE':
+                palette = np.frombuffer(f.read(length), dtype=np.uint8).reshape(-1, 3)
+            elif chunk_type == b'tRNS' and palette is not None:
+                alpha = np.frombuffer(f.read(length), dtype=np.uint8)
+            elif chunk_type == b'IDAT':
+                if not started:
+                    started = True
+                    if color_type == 3:
+                        channels = 3 if alpha is None else 4
+                    yield width, height, channels, depth
+                remaining = length
+                while remaining:
+                    data = f.read(min(chunk_size, remaining))
+                    remaining -= len(data)
+                    # Bound the decompressed size, data may compress very well
+                    while data:
+                        pending += decompressor.decompress(data, chunk_size)
+                        data = decompressor.unconsumed_tail
+                        count = min(len(pending) // stride, height - rows)
+                        if not count or (count < strip_rows and rows + count < height):
+                            continue
+                        strip = np.frombuffer(pending, dtype=np.uint8, count=count * stride)
+                        strip = strip.reshape(count, stride).copy()
+                        del pending[:count * stride]
+                        strip = _unfilter_png_strip(strip[:, 0], strip[:, 1:], previous, bpp)
+                        previous = strip[-1]
+                        rows += count
+                        for row in strip:
+                            yield pixels(row)
+                f.read(4)  # CRC
+                continue
+            elif chunk_type == b'IEND':
+                break
+            else:
+                f.seek(length, os.SEEK_CUR)
+            f.read(4)  # CRC
+        if rows < height:
+            raise ValueError("Truncated PNG file")
+
+
+class PngWriter:
+    """Write a PNG file one scanline at a time"""
+
+    def __init__(self, filepath, width, height, channels, depth, chunk_size=1 << 20):
+        self.depth = depth
+        self.chunk_size = chunk_size
+        self.file = open(filepath, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, depth,
+                                         color_type, 0, 0, 0))
+        self.compressor = zlib.compressobj(6)
+        self.buffer = b''
+
+    def _chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)) + chunk_type + data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write_row(self, row):
+        row = np.asarray(row, dtype='>u2' if self.depth == 16 else np.uint8)
+        self.buffer += self.compressor.compress(b'\x00' + row.tobytes())
+        if len(self.buffer) >= self.chunk_size:
+            self._chunk(b'IDAT', self.buffer)
+            self.buffer = b''
+
+    def close(self):
+        self._chunk(b'IDAT', self.buffer + self.compressor.flush())
+        self._chunk(b'IEND', b'')
+        self.file.close()
+
+
+class AreaResampler:
+    """Downsample an image fed one row at a time, with an area filter.
+
+    Only one output row is accumulated at a time, finished rows are passed
+    to emit.
+    """
+
+    def __init__(self, src_width, src_height, width, height, emit):
+        self.src_width = src_width
+        self.width = width
+        self.height = height
+        self.emit = emit
+        self.x_edges = np.linspace(0, src_width, width + 1)
+        self.y_scale = src_height / height
+        self.accumulator = None
+        self.src_row = 0
+        self.row = 0
+
+    def _resample_row(self, row):
+        # Integrate the row, then sample the integral at output pixel edges
+        integral = np.zeros((self.src_width + 1, row.shape[1]))
+        np.cumsum(row, axis=0, out=integral[1:])
+        positions = np.arange(self.src_width + 1)
+        edges = np.column_stack([np.interp(self.x_edges, positions, integral[:, c])
+                                 for c in range(row.shape[1])])
+        return np.diff(edges, axis=0) * (self.width / self.src_width)
+
+    def add_row(self, row):
+        row = self._resample_row(row.astype(np.float64))
+        if self.accumulator is None:
+            self.accumulator = np.zeros_like(row)
+        top = float(self.src_row)
+        bottom = top + 1.0
+        while top < bottom and self.row < self.height:
+            edge = (self.row + 1) * self.y_scale
+            part = min(bottom, edge) - top
+            self.accumulator += row * part
+            top += part
+            if top >= edge - 1e-9:
+                self._emit()
+        self.src_row += 1
+
+    def _emit(self):
+        self.emit(self.accumulator / self.y_scale)
+        self.accumulator[:] = 0.0
+        self.row += 1
+
+    def finish(self):
+        # Rounding may leave the last row a tiny bit short
+        while self.row < self.height:
+            self._emit()
+
+
+# Suffix of the proxy files being written, before their extension
+PARTIAL_SUFFIX = ".part"
+
+
+def partial_proxy_file(destination):
+    """Create a temporary file next to destination, unique to its writer.
+
+    Proxies are written to it, then renamed to destination once complete,
+    so that neither a killed writer nor several processes writing the same
+    proxy leave a truncated file behind.
+    """
+    directory, filename = os.path.split(destination)
+    name, ext = os.path.splitext(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, partial = tempfile.mkstemp(prefix=name + ".", suffix=PARTIAL_SUFFIX + ext,
+                                   dir=directory)
+    os.close(fd)
+    return partial
+
+
+def stream_proxies(source, levels, report=None):
+    """Resize a PNG file to several widths, decoding and writing it in strips.
+
+    levels is a list of (destination, width) pairs. Memory use is
+    proportional to a strip of rows of the source rather than to the whole
+    image.
+    Stage times are added to report under source, if given.
+    Return the list of written destinations.
+    """
+    seconds = dict.fromkeys(('load', 'scale', 'encode', 'save'), 0.0)
+    rows = iter_png_rows(source)
+    start = time.perf_counter()
+    src_width, src_height, channels, depth = next(rows)
+    seconds['load'] += time.perf_counter() - start
+    # Proxies are written in 8 bit
+    scale = 255 / ((1 << depth) - 1)
+    # Rows are resampled as float64, with their integral
+    memory = src_width * channels * 8 * 3
+    # A strip of rows, filtered and decoded, skewed as int16 to undo filters
+    strip_bytes = min(PNG_STRIP_BYTES, src_height * src_width * channels * depth // 8)
+    memory += strip_bytes * 5
+    partials = []
+    writers = []
+    resamplers = []
+    for destination, width in levels:
+        width = min(width, src_width)
+        height = max(1, round(src_height * width / src_width))
+        partials.append(partial_proxy_file(destination))
+        writer = PngWriter(partials[-1], width, height, channels, 8)
+        memory += width * channels * 8
+
+        def emit(row, writer=writer):
+            start = time.perf_counter()
+            writer.write_row(np.clip(np.rint(row * scale), 0, 255))
+            seconds['encode'] += time.perf_counter() - start
+
+        writers.append(writer)
+        resamplers.append(AreaResampler(src_width, src_height, width, height, emit))
+
+    try:
+        while True:
+            start = time.perf_counter()
+            row = next(rows, None)
+            seconds['load'] += time.perf_counter() - start
+            if row is None:
+                break
+            start = time.perf_counter()
+            for resampler in resamplers:
+                resampler.add_row(row)
+            seconds['scale'] += time.perf_counter() - start
+        start = time.perf_counter()
+        for resampler in resamplers:
+            resampler.finish()
+        seconds['scale'] += time.perf_counter() - start
+    except Exception:
+        for writer, partial in zip(writers, partials):
+            writer.close()
+            os.remove(partial)
+        raise
+    start = time.perf_counter()
+    for writer in writers:
+        writer.close()
+
+    for partial, (destination, width) in zip(partials, levels):
+        os.replace(partial, destination)
+    seconds['save'] += time.perf_counter() - start
+
+    if report is not None:
+        # Rows are encoded while being resampled
+        seconds['scale'] -= seconds['encode']
+        for stage, stage_seconds in seconds.items():
+            report.add(source, stage, stage_seconds)
+        report.add(source, bytes_read=os.path.getsize(source),
+                   bytes_written=sum(os.path.getsize(destination)
+                                     for destination, width in levels),
+                   memory=memory)
+    return [destination for destination, width in levels]
+
+
+def proxy_filepath(filepath, width, extension=None):
+    """Return the path of the proxy file for an absolute image path.
+
+    The name holds a key made from the source file name, modification time
+    and size and the proxy width, so that a proxy file found on disk is
+    always up to date and can be reused by any .blend file. The proxy is
+    encoded according to extension, the source one by default.
+    """
+    stat = os.stat(filepath)
+    path, ext = os.path.splitext(filepath)
+    path, filename = os.path.split(path)
+    extension = extension or ext
+    key = "{}:{}:{}:{}".format(filename + ext, stat.st_mtime_ns, stat.st_size, width)
+    key = hashlib.sha1(key.encode()).hexdigest()[:12]
+    filename += "_proxy_{}_{}{}".format(width, key, extension)
+    return os.path.join(path, 'proxy', filename)
+
+
+def proxy_extension(img, source, proxy_format, stream_threshold=0):
+    """Return the file extension to encode the proxies of an image with.
+
+    In 'AUTO' format, float images and data maps of more than 8 bits get
+    half float EXR proxies, keeping the precision of displacement and
+    normal maps. Other data maps and images with alpha get PNG ones, and
+    other color images JPEG ones. PNG images of at least stream_threshold
+    megapixels also get PNG proxies, as only those can be written in
+    strips.
+    """
+    ext = os.path.splitext(source)[1].lower()
+    if proxy_format == 'SOURCE':
+        return ext
+    if proxy_format in PROXY_FORMAT_EXTENSIONS:
+        return PROXY_FORMAT_EXTENSIONS[proxy_format]
+    if ext in FLOAT_EXTENSIONS:
+        return '.exr'
+    info = image_file_info(source)
+    if img.colorspace_settings.name in DATA_COLORSPACES:
+        return '.exr' if info is None or info[3] > 8 else '.png'
+    if info is None or (info[2] in {2, 4} and img.use_alpha):
+        return '.png'
+    if (stream_threshold and ext == '.png'
+            and info[0] * info[1] >= stream_threshold * 1000000):
+        return '.png'
+    return '.jpg'
+
+
+def evict_proxy_cache(directory, max_size, keep=()):
+    """Remove least recently used proxies until directory fits in max_size bytes.
+
+    Files listed in keep are never removed.
+    """
+    entries = []
+    total = 0
+    for entry in os.scandir(directory):
+        # Proxies being written are not part of the cache yet
+        if (entry.is_file() and "_proxy_" in entry.name
+                and PARTIAL_SUFFIX + "." not in entry.name):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:  # used or removed by someone else
+            continue
+        total -= size
+
+
+class ProxyGenerator:
+    """Background Blender processes resizing image files.
+
+    jobs is a list of (source, levels) tuples, levels being a list of
+    (destination, width) pairs, with absolute paths. Each source is decoded
+    once and resized to all its levels, from the largest to the smallest.
+    The jobs are spread over workers processes (0 uses all cores), which
+    report each proxy as soon as it is written, and the time spent on each
+    source once done with it. PNG sources of at least
+    stream_threshold megapixels (0 to disable) are resized in strips
+    rather than loaded whole.
+    """
+
+    def __init__(self, jobs, workers=0, stream_threshold=0):
+        # Several datablocks may use the same file
+        unique_jobs = {}
+        for source, levels in jobs:
+            unique_jobs.setdefault(source, {}).update(levels)
+        unique_jobs = [(source, sorted(levels.items(), key=lambda l: -l[1]))
+                       for source, levels in unique_jobs.items()]
+        self.destinations = {destination
+                             for source, levels in unique_jobs
+                             for destination, width in levels}
+        self._done = set()
+        self._processes = []
+        self._job_files = []
+        self._offsets = {}
+        if not unique_jobs:
             return
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(unique_jobs))
+
+        for i in range(workers):
+            fd, job_file = tempfile.mkstemp(prefix="proxy_jobs_", suffix=".json")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(unique_jobs[i::workers], f)
+            self._job_files.append(job_file)
+            self._processes.append(subprocess.Popen(
+                [bpy.app.binary_path, '--background', '--factory-startup',
+                 '--python', os.path.abspath(__file__),
+                 '--', 'worker', job_file,
+                 '--stream-threshold', str(stream_threshold)]))
+
+    def running(self):
+        return any(process.poll() is None for process in self._processes)
+
+    def wait(self):
+        for process in self._processes:
+            process.wait()
+
+    def _new_lines(self, path):
+        """Return the lines a worker appended to a file since the last call"""
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'rb') as f:
+            f.seek(self._offsets.get(path, 0))
+            lines = f.read()
+        # Only count complete lines, the worker may be writing
+        lines = lines[:lines.rfind(b"\n") + 1]
+        self._offsets[path] = self._offsets.get(path, 0) + len(lines)
+        return lines.decode('utf-8').splitlines()
+
+    def done(self):
+        """Return the set of destinations written so far"""
+        for job_file in self._job_files:
+            self._done.update(self._new_lines(job_file + ".done"))
+        return self._done
+
+    def reports(self):
+        """Return the report items of the sources finished since the last call.
+
+        Each one is a StageReport item with a "source" key.
+        """
+        return [json.loads(line)
+                for job_file in self._job_files
+                for line in self._new_lines(job_file + ".log")]
+
+    def failed(self):
+        """Return the set of destinations which could not be written"""
+        return self.destinations - self.done()
+
+    def close(self):
+        """Stop the workers if still running, and remove temporary files"""
+        for process in self._processes:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+        for job_file in self._job_files:
+            for path in (job_file, job_file + ".done", job_file + ".log"):
+                if os.path.isfile(path):
+                    os.remove(path)
+        self._processes = []
+        self._job_files = []
+
+
+def generate_proxies(jobs, workers=0, stream_threshold=0):
+    """Resize image files, see ProxyGenerator.
+
+    Return the set of destinations which could not be written.
+    """
+    generator = ProxyGenerator(jobs, workers, stream_threshold)
+    try:
+        generator.wait()
+        return generator.failed()
+    finally:
+        generator.close()
+
+
+def generate_proxies_worker(job_file, stream_threshold=0):
+    """Resize the images listed in job_file (run inside a worker process)"""
+    with open(job_file) as f:
+        jobs = json.load(f)
+
+    scene = bpy.context.scene
+    done = open(job_file + ".done", 'w')
+    log = open(job_file + ".log", 'w')
+    report = StageReport('proxify')
+    for source, levels in jobs:
+        info = image_file_info(source)
+        if (stream_threshold and info is not None
+                and source.lower().endswith('.png')
+                and all(destination.endswith('.png') for destination, width in levels)
+                and info[0] * info[1] >= stream_threshold * 1000000):
+            try:
+                for destination in stream_proxies(source, levels, report):
+                    done.write(destination + "\n")
+                done.flush()
+                log.write(json.dumps(dict(report.items[source], source=source)) + "\n")
+                log.flush()
+                continue
+            except Exception as e:  # unsupported PNG flavour, load it whole
+                print("Proxy: could not stream {}: {}".format(source, e))
+                report.items.pop(source, None)
+        try:
+            with report.stage(source, 'load'):
+                img = bpy.data.images.load(source)
+                # Pixels are decoded on first access
+                w, h = img.size
+        except Exception as e:
+            print("Proxy: could not load {}: {}".format(source, e))
+            continue
+        report.add(source, bytes_read=os.path.getsize(source),
+                   memory=image_memory(w, h, img.is_float))
+        # Levels are sorted from the largest, each one is resized from
+        # the previous one
+        for destination, width in levels:
+            try:
+                w, h = img.size
+                if width < w:
+                    with report.stage(source, 'scale'):
+                        img.scale(width, max(1, round(h * width / w)))
+
+                ext = os.path.splitext(destination)[1].lower()
+                settings = scene.render.image_settings
+                settings.file_format = EXTENSION_FORMATS.get(ext, 'PNG')
+                for setting, value in PROXY_IMAGE_SETTINGS[settings.file_format].items():
+                    setattr(settings, setting, value)
+
+                partial = partial_proxy_file(destination)
+                try:
+                    # save_render encodes and writes the file in one go
+                    with report.stage(source, 'encode'):
+                        img.save_render(partial, scene=scene)
+                    with report.stage(source, 'save'):
+                        os.replace(partial, destination)
+                except Exception:
+                    if os.path.isfile(partial):
+                        os.remove(partial)
+                    raise
+                report.add(source, bytes_written=os.path.getsize(destination))
+            except Exception as e:  # keep going with the other images
+                print("Proxy: could not process {}: {}".format(source, e))
+            else:
+                done.write(destination + "\n")
+                done.flush()
+        bpy.data.images.remove(img)
+        log.write(json.dumps(dict(report.items[source], source=source)) + "\n")
+        log.flush()
+    done.close()
+    log.close()
+
+
+def proxy_levels(scene, width):
+    """Return the pyramid widths to generate for an image of the given width"""
+    levels = {scene.proxy_destination}
+    for level in scene.proxy_levels.split(','):
+        try:
+            levels.add(int(level))
+        except ValueError:
+            continue
+    return sorted(level for level in levels if 0 < level < width)
+
+
+class ProxyRegistry:
+    """Map between proxy images and their originals, in both directions.
+
+    Each pair shares a 'proxy_uid' ID property, so renaming either image
+    keeps them paired. The map is built from bpy.data.images on first use,
+    then updated as images are proxified and deproxified. It is dropped on
+    file load and undo, when the image datablocks are replaced.
+    """
+
+    def __init__(self):
+        self._proxies = None
+        self._originals = None
+
+    def _build(self):
+        self._proxies = {}
+        self._originals = {}
+        for img in bpy.data.images:
+            if 'is_proxy' not in img:
+                continue
+            if img['is_proxy'] and 'proxy_uid' not in img:
+                # Proxy made before uids, paired by name
+                original = bpy.data.images.get(img.get('original', ''))
+                if original is None:
+                    continue
+                img['proxy_uid'] = original['proxy_uid'] = uuid.uuid4().hex
+                self._originals[img['proxy_uid']] = original
+            if 'proxy_uid' not in img:
+                continue
+            if img['is_proxy']:
+                self._proxies[img['proxy_uid']] = img
+            else:
+                self._originals[img['proxy_uid']] = img
+
+    def _ensure(self):
+        if self._proxies is None:
+            self._build()
+
+    def invalidate(self):
+        self._proxies = None
+        self._originals = None
+
+    def proxies(self):
+        """Return all proxy images"""
+        self._ensure()
+        return list(self._proxies.values())
+
+    def orphans(self):
+        """Return original images whose proxy is gone"""
+        self._ensure()
+        return [img for uid, img in self._originals.items()
+                if uid not in self._proxies]
+
+    def original(self, proxy):
+        """Return the original of a proxy image, or None"""
+        self._ensure()
+        return self._originals.get(proxy.get('proxy_uid'))
+
+    def proxy(self, original):
+        """Return the proxy of an original image, or None"""
+        self._ensure()
+        return self._proxies.get(original.get('proxy_uid'))
+
+    def add(self, proxy, original):
+        self._ensure()
+        uid = uuid.uuid4().hex
+        proxy['proxy_uid'] = original['proxy_uid'] = uid
+        self._proxies[uid] = proxy
+        self._originals[uid] = original
+
+    def remove(self, img):
+        """Forget the pair img belongs to"""
+        self._ensure()
+        uid = img.get('proxy_uid')
+        self._proxies.pop(uid, None)
+        self._originals.pop(uid, None)
+
+
+proxy_registry = ProxyRegistry()
+
+
+@bpy.app.handlers.persistent
+def invalidate_proxy_registry(dummy):
+    proxy_registry.invalidate()
+
+
+def proxy_source(img):
+    """Return the absolute path of the original file of a proxy"""
+    original = proxy_registry.original(img)
+    if original is None:
+        raise KeyError(img.name)
+    return os.path.normpath(bpy.path.abspath(original.filepath))
+
+
+def proxy_files_in_use(scene):
+    """Return the proxy files the proxies of the open file use or can switch to"""
+    paths = set()
+    for img in proxy_registry.proxies():
+        paths.add(os.path.normpath(bpy.path.abspath(img.filepath)))
+        try:
+            source = proxy_source(img)
+            info = image_file_info(source)
+            if info is None:
+                continue
+            for level in proxy_levels(scene, info[0]):
+                paths.add(proxy_filepath(source, level, img.get('proxy_extension')))
+        except (KeyError, OSError):
+            continue
+    return paths
+
+
+def set_proxy_level(img, width):
+    """Point a proxy to the pyramid level of the given width.
 
-    if img.source == 'FILE' and img.size[0] > bpy.context.scene.proxy_width_threshold:
-        #ignore images which are already proxies
+    Return False if this level is not on disk.
+    """
+    if img.get('proxy_width') == width:
+        return True
+    try:
+        path = proxy_filepath(proxy_source(img), width, img.get('proxy_extension'))
+    except (KeyError, OSError):
+        return False
+    if not os.path.isfile(path):
+        return False
+    os.utime(path)
+    img.filepath = path
+    img['proxy_width'] = width
+    img.reload()
+    return True
+
+
+def update_proxy_level(self, context):
+    """Switch all proxies to the destination width, where already generated"""
+    for img in proxy_registry.proxies():
+        set_proxy_level(img, self.proxy_destination)
+
+
+def needs_proxy(img, width=None):
+    """Return whether img should be proxified to width.
+
+    By default, width is the scene destination width, and images are only
+    proxified if wider than the scene threshold. Proxies are switched to
+    width if that level exists. Otherwise they need the level generated,
+    and are only switched to it once it is written, see use_proxy().
+    """
+    scene = bpy.context.scene
+    if width is None:
+        width = scene.proxy_destination
+        threshold = scene.proxy_width_threshold
+    else:
+        threshold = width
+    if 'is_proxy' in img:
+        if not img['is_proxy']:
+            #ignore original images
+            return False
+        proxy_width = img.get('proxy_width')
+        if proxy_width is None:
+            proxy_width = image_width(img)
+        if proxy_width == width:
+            return False
+        if set_proxy_level(img, width):
+            return False
+        original = proxy_registry.original(img)
+        return original is not None and image_width(original) > threshold
+
+    return img.source == 'FILE' and image_width(img) > threshold
+
+
+def use_proxy(img, path, width, reload=True):
+    """Keep a copy of img as the original, and point img to the proxy file.
+
+    Proxies of another width keep their original, and are only pointed to
+    the new file. With reload False, only the path is changed and the
+    image must be reloaded by the caller, see ImageReloader.
+    """
+    if not img.get('is_proxy'):
         img_orig = img.copy()
         img_orig.use_fake_user = True
         img_orig['is_proxy'] = False
@@ -52,85 +1028,640 @@ def proxify(img):
 
         img['is_proxy'] = True
         img['original'] = img_orig.name
+        proxy_registry.add(img, img_orig)
         img['use_alpha'] = img_orig.use_alpha
         img.use_alpha = True
+    img['proxy_width'] = width
+    img['proxy_extension'] = os.path.splitext(path)[1]
 
-        dest = bpy.context.scene.proxy_destination
-        w, h = img.size
-        h *= dest/w
-        w = dest
-        img.scale(w,h)
-
-        path, ext = os.path.splitext(bpy.path.abspath(img.filepath))
-        path, filename = os.path.split(path)
-        filename += "_proxy" + ext
-        path = os.path.join(path, 'proxy', filename)
-        img.save_render(path, scene=bpy.context.scene)
+    if reload:
         img.filepath = path
-
         img.reload()
+    else:
+        img.filepath_raw = path
+
+
+def iter_proxify_images(images, failed_images, report=None, widths=None):
+    """Proxify images, resizing them in parallel to every pyramid level.
+
+    Each step yields a (stage, done, total) progress tuple, or None while
+    waiting for the workers, so that the work can be spread over a modal
+    operator. Each image is either fully proxified or left untouched if
+    the generator is closed early. Images which could not be proxified are
+    appended to failed_images. The stages of each image are added to
+    report, if given. widths maps image pointers to the width of their
+    proxy, see needs_proxy().
+    """
+    if report is None:
+        report = StageReport('proxify')
+    scene = bpy.context.scene
+    proxy_images = []
+    jobs = []
+    for i, img in enumerate(images):
+        yield ("Checking", i, len(images))
+        width = widths.get(img.as_pointer()) if widths else None
+        if not needs_proxy(img, width):
+            continue
+        width = width or scene.proxy_destination
+        # Proxies of another width are resized from their original
+        original = proxy_registry.original(img) if img.get('is_proxy') else img
+        source = os.path.normpath(bpy.path.abspath(original.filepath))
+        if not os.path.isfile(source):
+            failed_images.append(img)
+            continue
+        levels = proxy_levels(scene, image_width(original))
+        if width not in levels:
+            continue
+        extension = proxy_extension(original, source, scene.proxy_format,
+                                    scene.proxy_stream_threshold)
+        levels = [(proxy_filepath(source, level, extension), level)
+                  for level in levels]
+        proxy_images.append((img, proxy_filepath(source, width, extension), width))
+        jobs.append((source, levels))
+
+    # Reuse proxies already on disk, marking them as recently used
+    missing_jobs = []
+    destinations = set()
+    for source, levels in jobs:
+        missing_levels = []
+        for destination, level in levels:
+            destinations.add(destination)
+            if os.path.isfile(destination):
+                os.utime(destination)
+            else:
+                missing_levels.append((destination, level))
+        if missing_levels:
+            missing_jobs.append((source, missing_levels))
+
+    print("Proxy: resizing {} images, {} found in cache...".format(
+        len(missing_jobs), len(jobs) - len(missing_jobs)))
+    # Worker stages are reported by source, files shared by several
+    # images are counted once
+    source_images = {}
+    for (img, destination, width), (source, levels) in zip(proxy_images, jobs):
+        source_images.setdefault(source, img.name)
+
+    # Most visible images first
+    priorities = image_priorities(bpy.context)
+    proxy_images.sort(key=lambda i: priorities.get(i[0].as_pointer(), 3))
+
+    generator = ProxyGenerator(missing_jobs, scene.proxy_workers,
+                               scene.proxy_stream_threshold)
+    reloader = ImageReloader(report)
+    try:
+        # Switch images to their proxy as soon as it is written, and
+        # reload them once the file is read
+        total = len(proxy_images)
+        applied = 0
+        while proxy_images:
+            running = generator.running()
+            done = generator.done()
+            waiting = []
+            for img, destination, width in proxy_images:
+                if destination not in generator.destinations or destination in done:
+                    with report.stage(img.name, 'swap'):
+                        use_proxy(img, destination, width, reload=False)
+                    reloader.add(img)
+                    applied += 1
+                    yield ("Proxifying", applied, total)
+                elif running:
+                    waiting.append((img, destination, width))
+                else:
+                    failed_images.append(img)
+            reloader.reload_ready()
+            proxy_images = waiting
+            if proxy_images:
+                yield None
+        yield from reloader.iter_reload()
+    finally:
+        try:
+            reloader.close()
+        finally:
+            try:
+                for item in generator.reports():
+                    report.merge(source_images.get(item["source"], item["source"]), item)
+            finally:
+                generator.close()
+
+    if scene.proxy_cache_size > 0:
+        keep = destinations | proxy_files_in_use(scene)
+        for directory in {os.path.dirname(path) for path in destinations}:
+            evict_proxy_cache(directory, scene.proxy_cache_size * 1024 * 1024,
+                              keep=keep)
+
+
+def proxify_images(images, report=None):
+    """Proxify images, see iter_proxify_images.
+
+    Return the list of images which could not be proxified.
+    """
+    failed_images = []
+    for progress in iter_proxify_images(images, failed_images, report):
+        if progress is None:
+            time.sleep(0.1)
+    return failed_images
+
+
+def proxify(img):
+    proxify_images([img])
+
+
+def original_file_info(img):
+    """Return the path of the full resolution file of an image and its
+    image_file_info(), or (None, None) if unknown"""
+    if img.source != 'FILE' or img.packed_file:
+        return None, None
+    if img.get('is_proxy'):
+        try:
+            path = proxy_source(img)
+        except KeyError:
+            return None, None
+    else:
+        path = os.path.normpath(bpy.path.abspath(img.filepath))
+    return path, image_file_info(path)
+
+
+def plan_memory_budget(context, budget):
+    """Choose the width of the images of the scene to fit in budget bytes.
+
+    The memory of each image is estimated from its decoded size. Images
+    start at their smallest pyramid level, then are raised one level at a
+    time, all images of a priority before those of the next one (see
+    image_priorities), while the budget allows it. Return the plan, a
+    list of (image, width) pairs, width being None for full resolution,
+    and the estimated memory used.
+    """
+    scene = context.scene
+    priorities = image_priorities(context)
+    candidates = []
+    used = 0
+    for img in collect_images(scene.objects):
+        if 'is_proxy' in img and not img['is_proxy']:
+            continue
+        path, info = original_file_info(img)
+        if info is None:  # cannot be proxified, counted as is
+            used += image_memory(*img.size, is_float=img.is_float)
+            continue
+        width, height = info[:2]
+        is_float = os.path.splitext(path)[1].lower() in FLOAT_EXTENSIONS
+        levels = [(level, image_memory(level, max(1, round(height * level / width)), is_float))
+                  for level in proxy_levels(scene, width)]
+        levels.append((None, image_memory(width, height, is_float)))
+        candidates.append([priorities.get(img.as_pointer(), 3), img, levels, 0])
+        used += levels[0][1]
+
+    for priority in sorted({candidate[0] for candidate in candidates}):
+        group = [candidate for candidate in candidates if candidate[0] == priority]
+        raised = True
+        while raised:
+            raised = False
+            for candidate in group:
+                levels, level = candidate[2], candidate[3]
+                if level + 1 < len(levels):
+                    extra = levels[level + 1][1] - levels[level][1]
+                    if used + extra <= budget:
+                        candidate[3] = level + 1
+                        used += extra
+                        raised = True
+
+    plan = [(img, levels[level][0]) for priority, img, levels, level in candidates]
+    return plan, used
+
+
+def iter_apply_proxy_plan(plan, failed_images, report=None):
+    """Deproxify and proxify images according to a plan_memory_budget() plan.
+
+    Yield progress like iter_proxify_images.
+    """
+    full = [img for img, width in plan if width is None]
+    yield from iter_deproxify_images(images_to_deproxify(full), report)
+    widths = {img.as_pointer(): width for img, width in plan if width is not None}
+    images = [img for img, width in plan if width is not None]
+    yield from iter_proxify_images(images, failed_images, report, widths)
+
+
+def collect_images(objects):
+    """Return the images used by the materials of objects, in a stable order.
+
+    Each material and node tree is visited once, however many objects
+    share it. Texture slots, image texture nodes, texture nodes, material
+    nodes and node groups are followed.
+    """
+    images = collections.OrderedDict()
+    materials = []
+    visited = set()
+
+    def add_material(mat):
+        if mat is not None and mat.as_pointer() not in visited:
+            visited.add(mat.as_pointer())
+            materials.append(mat)
+
+    def add_texture(tex):
+        if tex is not None and tex.type == 'IMAGE' and tex.image is not None:
+            images.setdefault(tex.image.as_pointer(), tex.image)
+
+    def visit_tree(tree):
+        if tree is None or tree.as_pointer() in visited:
+            return
+        visited.add(tree.as_pointer())
+        for node in tree.nodes:
+            if node.type in {'TEX_IMAGE', 'TEX_ENVIRONMENT'}:
+                if node.image is not None:
+                    images.setdefault(node.image.as_pointer(), node.image)
+            elif node.type == 'TEXTURE':
+                add_texture(node.texture)
+            elif node.type in {'MATERIAL', 'MATERIAL_EXT'}:
+                add_material(node.material)
+            elif node.type == 'GROUP':
+                visit_tree(node.node_tree)
+
+    for obj in objects:
+        for slot in obj.material_slots:
+            add_material(slot.material)
+
+    # Material nodes may add materials while iterating
+    for mat in materials:
+        for tex_slot in mat.texture_slots:
+            if tex_slot is not None:
+                add_texture(tex_slot.texture)
+        if mat.use_nodes:
+            visit_tree(mat.node_tree)
+
+    return list(images.values())
+
 
 def get_selected_images():
-    images_selected = set()
-    for obj in bpy.context.selected_objects:
-        for mat in obj.material_slots:
-            for tex in mat.material.texture_slots:
-                if tex is not None and tex.texture.type == 'IMAGE' and tex.texture.image is not None:
-                    images_selected.add(tex.texture.image)
-    return images_selected
+    return collect_images(bpy.context.selected_objects)
+
+
+def camera_sees(scene, obj):
+    """Return whether the bounding box of obj overlaps the camera frame"""
+    if scene.camera is None:
+        return False
+    corners = [world_to_camera_view(scene, scene.camera, obj.matrix_world * Vector(corner))
+               for corner in obj.bound_box]
+    corners = [corner for corner in corners if corner.z > 0]
+    return bool(corners
+                and min(c.x for c in corners) <= 1 and max(c.x for c in corners) >= 0
+                and min(c.y for c in corners) <= 1 and max(c.y for c in corners) >= 0)
+
+
+def image_priorities(context):
+    """Return the priority of images by pointer, the most important first.
+
+    0 for images used by selected objects, 1 for those used by objects
+    the camera sees, 2 for those used by other visible objects. Images
+    missing from the result come last.
+    """
+    scene = context.scene
+    visible = [obj for obj in scene.objects if obj.is_visible(scene)]
+    seen = [obj for obj in visible if camera_sees(scene, obj)]
+    priorities = {}
+    for priority, objects in ((2, visible), (1, seen), (0, context.selected_objects)):
+        for img in collect_images(objects):
+            priorities[img.as_pointer()] = priority
+    return priorities
+
+
+def prefetch_file(path, chunk_size=1 << 22):
+    """Read a whole file, so that it is in the system cache when decoded.
+
+    Return the number of bytes read and the seconds it took.
+    """
+    start = time.perf_counter()
+    size = 0
+    buffer = bytearray(chunk_size)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            size += read
+    return size, time.perf_counter() - start
+
+
+# Threads reading image files ahead of their reload
+PREFETCH_THREADS = 4
+
+
+class ImageReloader:
+    """Reload images once their file has been read in the background.
+
+    Images added are reloaded in the same order, each one as soon as its
+    file has been read by a thread pool, so that Blender decodes it from
+    the system cache instead of waiting for the disk or the network.
+    Only file reads happen in the pool, bpy is not thread safe. Closing
+    the reloader reloads pending images right away.
+    """
+
+    def __init__(self, report=None, threads=PREFETCH_THREADS):
+        self.report = report
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._pending = collections.OrderedDict()
+        self.total = 0
+        self.reloaded = 0
+
+    def add(self, img):
+        path = bpy.path.abspath(img.filepath_raw)
+        self._pending[img.as_pointer()] = (
+            img, path, self._executor.submit(prefetch_file, path))
+        self.total += 1
 
+    def pending(self):
+        return len(self._pending)
 
-class ImageProxify(bpy.types.Operator):
+    def _reload(self, img, path, future):
+        try:
+            name = img.name
+        except ReferenceError:  # removed meanwhile, by an undo for instance
+            return
+        if self.report is not None:
+            with self.report.stage(name, 'reload'):
+                img.reload()
+            if (future.done() and not future.cancelled()
+                    and future.exception() is None):
+                size, seconds = future.result()
+                self.report.add(name, 'prefetch', seconds, bytes_read=size)
+            info = image_file_info(path)
+            if info is not None:
+                is_float = os.path.splitext(path)[1].lower() in FLOAT_EXTENSIONS
+                self.report.add(name, memory=image_memory(*info[:2], is_float=is_float))
+        else:
+            img.reload()
+        self.reloaded += 1
+
+    def reload_ready(self):
+        """Reload the images whose file has been read, return how many"""
+        ready = [key for key, (img, path, future) in self._pending.items()
+                 if future.done()]
+        for key in ready:
+            self._reload(*self._pending.pop(key))
+        return len(ready)
+
+    def iter_reload(self, timeout=0.05):
+        """Reload all pending images, yielding progress tuples like
+        iter_proxify_images, or None after waiting timeout seconds for
+        file reads"""
+        while self._pending:
+            if not self.reload_ready():
+                concurrent.futures.wait(
+                    [future for img, path, future in self._pending.values()],
+                    timeout, concurrent.futures.FIRST_COMPLETED)
+                if not self.reload_ready():
+                    yield None
+                    continue
+            yield ("Reloading", self.reloaded, self.total)
+
+    def close(self):
+        try:
+            for img, path, future in self._pending.values():
+                future.cancel()
+                self._reload(img, path, future)
+        finally:
+            self._pending.clear()
+            self._executor.shutdown(wait=False)
+
+
+# Seconds of work done at each timer event of the modal operators
+MODAL_TIME_SLICE = 0.05
+
+# Progress of the running modal operator, drawn in the panel
+proxy_progress = {}
+
+# StageReport of the last operation, as a dict, drawn in the panel
+proxy_report = {}
+
+
+def redraw_image_editors(context):
+    for area in context.screen.areas:
+        if area.type == 'IMAGE_EDITOR':
+            area.tag_redraw()
+
+
+class ModalImageOperator:
+    """Run the steps of iter_images() from a timer, a few at a time.
+
+    iter_images(context, report) yields (stage, done, total) tuples, or
+    None when there is nothing to do until the next timer event, and adds
+    the time spent on each image to report. Escape stops it between two
+    steps.
+    """
+
+    def start(self, context):
+        self._report = StageReport(self.bl_idname.split('.')[-1])
+        return self.iter_images(context, self._report)
+
+    def execute(self, context):
+        for progress in self.start(context):
+            if progress is None:
+                time.sleep(0.1)
+        self.save_report(context)
+        self.report_done()
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        if proxy_progress:
+            self.report({'WARNING'}, "Another proxy operation is running")
+            return {'CANCELLED'}
+        self._steps = self.start(context)
+        proxy_progress.update(stage="", done=0, total=0, start=time.time())
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.1, context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.finish(context)
+            self.report({'WARNING'}, "Cancelled")
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        end = time.time() + MODAL_TIME_SLICE
+        try:
+            while time.time() < end:
+                progress = next(self._steps)
+                if progress is None:
+                    break
+                stage, done, total = progress
+                if stage != proxy_progress['stage']:
+                    proxy_progress['start'] = time.time()
+                proxy_progress.update(stage=stage, done=done, total=total)
+        except StopIteration:
+            self.finish(context)
+            self.report_done()
+            return {'FINISHED'}
+        except Exception:
+            self.finish(context)
+            raise
+        redraw_image_editors(context)
+        return {'RUNNING_MODAL'}
+
+    def finish(self, context):
+        try:
+            self._steps.close()
+        finally:
+            context.window_manager.event_timer_remove(self._timer)
+            proxy_progress.clear()
+        self.save_report(context)
+        redraw_image_editors(context)
+
+    def save_report(self, context):
+        """Keep the report for the panel, and log it if asked to"""
+        self._report.finish()
+        proxy_report.clear()
+        proxy_report.update(self._report.as_dict())
+        if context.scene.proxy_report_file:
+            try:
+                write_report(proxy_report, bpy.path.abspath(context.scene.proxy_report_file))
+            except OSError as e:
+                self.report({'WARNING'}, "Could not write report: {}".format(e))
+
+    def report_done(self):
+        pass
+
+
+class ImageProxify(ModalImageOperator, bpy.types.Operator):
     """Resize large images for performance"""
     bl_idname = "image.proxify"
     bl_label = "Proxify Images"
 
-    def execute(self, context):
-        images_to_process = get_selected_images() if bpy.context.scene.proxy_only_selected else bpy.data.images
-
-        number_imgs = len(images_to_process)
+    def iter_images(self, context, report):
+        images_to_process = get_selected_images() if context.scene.proxy_only_selected else list(bpy.data.images)
+        self._failed_images = []
+        return iter_proxify_images(images_to_process, self._failed_images, report)
 
-        for i, img in enumerate(images_to_process):
-            print("Proxy: processing image {:03} of {:03} : {}".format(i+1, number_imgs, img.name))
-            proxify(img)
+    def report_done(self):
+        if self._failed_images:
+            self.report({'WARNING'}, "Could not proxify {} images: {}".format(
+                len(self._failed_images), ", ".join(img.name for img in self._failed_images)))
         print("Proxy: done.")
-        return {'FINISHED'}
 
-def deproxify(img):
-    if 'is_proxy' in img:
-        if img['is_proxy']:
-            #print(bpy.data.images[img.name+'_orig'].filepath)
-            img.filepath = bpy.data.images[img.name+'_orig'].filepath
-            img.reload()
-            del img['is_proxy']
-            del img['original']
-            img.use_alpha = img['use_alpha']
-            del img['use_alpha']
-        else: #is an original image
-            img.name += '_garbage'
-            img.user_clear()
-            bpy.data.images.remove(img)
 
+def remove_original(original):
+    original.name += '_garbage'
+    original.user_clear()
+    bpy.data.images.remove(original)
+
+
+def deproxify(img, reload=True):
+    """Point a proxy back to its original file, and remove the original copy.
+
+    Deproxifying an original image deproxifies its proxy. With reload
+    False, the image must be reloaded by the caller, see ImageReloader.
+    Return the deproxified image, or None if there was none.
+    """
+    if 'is_proxy' not in img:
+        return None
+    if not img['is_proxy']:
+        proxy = proxy_registry.proxy(img)
+        if proxy is not None:
+            return deproxify(proxy, reload)
+        else:  # orphan original
+            proxy_registry.remove(img)
+            remove_original(img)
+        return None
+
+    original = proxy_registry.original(img)
+    if original is None:
+        print("Deproxy: original of {} not found".format(img.name))
+        return None
+    if reload:
+        img.filepath = original.filepath
+        img.reload()
+    else:
+        img.filepath_raw = original.filepath
+    proxy_registry.remove(img)
+    remove_original(original)
+    for prop in ('is_proxy', 'original', 'proxy_uid', 'proxy_width', 'proxy_extension'):
+        if prop in img:
+            del img[prop]
+    img.use_alpha = img['use_alpha']
+    del img['use_alpha']
+    return img
+
+
+def images_to_deproxify(images):
+    """Return the proxies and orphan originals among images, each once"""
+    result = collections.OrderedDict()
+    for img in images:
+        if 'is_proxy' not in img:
+            continue
+        if not img['is_proxy']:
+            proxy = proxy_registry.proxy(img)
+            if proxy is not None:
+                img = proxy
+        result[img.name] = img
+    return list(result.values())
+
+
+def iter_deproxify_images(images, report=None):
+    """Deproxify images, yielding (stage, done, total) after each one.
+
+    Images are switched to their original file at once, then reloaded
+    as their file is read in the background, see ImageReloader. The
+    stages of each image are added to report, if given.
+    """
+    if report is None:
+        report = StageReport('deproxify')
+    # Most visible images first
+    priorities = image_priorities(bpy.context)
+    images = sorted(images, key=lambda img: priorities.get(img.as_pointer(), 3))
+    reloader = ImageReloader(report)
+    try:
+        for i, img in enumerate(images):
+            print("Deproxy: processing image {:03} of {:03} : {}".format(i+1, len(images), img.name))
+            with report.stage(img.name, 'swap'):
+                img = deproxify(img, reload=False)
+            # Orphan originals are removed rather than reloaded
+            if img is not None:
+                reloader.add(img)
+            reloader.reload_ready()
+            yield ("Deproxifying", i+1, len(images))
+        yield from reloader.iter_reload()
+    finally:
+        reloader.close()
+
+
+class ImageProxyBudget(ModalImageOperator, bpy.types.Operator):
+    """Proxify the images of the scene to fit in the memory budget, keeping the most visible ones sharpest"""
+    bl_idname = "image.proxy_budget"
+    bl_label = "Fit Memory Budget"
+
+    def iter_images(self, context, report):
+        self._budget = context.scene.proxy_memory_budget * 1024 * 1024
+        plan, self._used = plan_memory_budget(context, self._budget)
+        self._failed_images = []
+        return iter_apply_proxy_plan(plan, self._failed_images, report)
 
-class ImageDeProxify(bpy.types.Operator):
+    def report_done(self):
+        if self._used > self._budget:
+            self.report({'WARNING'}, "Even the smallest proxies take {:.0f} MB, over the budget".format(
+                self._used / (1 << 20)))
+        else:
+            self.report({'INFO'}, "Images take about {:.0f} MB".format(self._used / (1 << 20)))
+        if self._failed_images:
+            self.report({'WARNING'}, "Could not proxify {} images: {}".format(
+                len(self._failed_images), ", ".join(img.name for img in self._failed_images)))
+
+
+class ImageDeProxify(ModalImageOperator, bpy.types.Operator):
     """Reset proxy images to their original side"""
     bl_idname = "image.deproxify"
     bl_label = "Deproxify Images"
 
-    def execute(self, context):
+    def iter_images(self, context, report):
         #try to avoid crashing when an original image is visible in UI and deleted
-        for area in bpy.context.screen.areas:
+        for area in context.screen.areas:
             if area.type == 'IMAGE_EDITOR':
                 displayed_img = area.spaces.active.image
                 if displayed_img is not None and 'is_proxy' in displayed_img and not displayed_img['is_proxy']:# and not displayed_img['is_proxy']:
                     area.spaces.active.image = None
 
-        images_to_process = get_selected_images() if bpy.context.scene.proxy_only_selected else bpy.data.images
-        number_imgs = len(images_to_process)
-        for i, img in enumerate(images_to_process):
-            print("Deproxy: processing image {:03} of {:03} : {}".format(i+1, number_imgs, img.name))
-            deproxify(img)
-        return {'FINISHED'}
+        images_to_process = get_selected_images() if context.scene.proxy_only_selected else proxy_registry.proxies() + proxy_registry.orphans()
+        images_to_process = images_to_deproxify(images_to_process)
+        return iter_deproxify_images(images_to_process, report)
 
 class ImageProxyPanel(bpy.types.Panel):
     """Image proxy panel"""
@@ -149,16 +1680,36 @@ class ImageProxyPanel(bpy.types.Panel):
         col = layout.column(align=True)
         col.prop(scene, "proxy_width_threshold")
         col.prop(scene, "proxy_destination")
+        col.prop(scene, "proxy_levels")
+        col.prop(scene, "proxy_format")
         col.prop(scene, "proxy_only_selected")
+        col.prop(scene, "proxy_workers")
+        col.prop(scene, "proxy_cache_size")
+        col.prop(scene, "proxy_stream_threshold")
+        col.prop(scene, "proxy_report_file")
         col.separator()
 
         col = layout.column(align=True)
-        col.operator("image.proxify")
-        col.operator("image.deproxify")
+        if proxy_progress:
+            done, total = proxy_progress['done'], proxy_progress['total']
+            col.label("{}: {} of {}".format(proxy_progress['stage'], done, total))
+            elapsed = time.time() - proxy_progress['start']
+            if done and elapsed > 0:
+                rate = done / elapsed
+                col.label("{:.1f} images/s, {:.0f} s left".format(rate, (total - done) / rate))
+            col.label("Press Esc to cancel")
+        else:
+            col.operator("image.proxify")
+            col.operator("image.deproxify")
+            col.separator()
+            col.prop(scene, "proxy_memory_budget")
+            col.operator("image.proxy_budget")
+            if proxy_report:
+                self.draw_report(layout.box())
         img = context.area.spaces.active.image
         if img is None:
             return
-        col.separator()
+        col = layout.column(align=True)
         if not 'is_proxy' in img:
             col.label("This image is not a proxy.")
         elif not img['is_proxy']:
@@ -167,21 +1718,103 @@ class ImageProxyPanel(bpy.types.Panel):
             col.label("This image is a proxy.")
         col.label("Its width is %s pixels" % img.size[0])
 
+    def draw_report(self, layout):
+        col = layout.column(align=True)
+        col.label("Last {}: {} images in {:.1f} s".format(
+            proxy_report['operation'], len(proxy_report['items']), proxy_report['seconds']))
+        totals = stage_totals(proxy_report)
+        if totals:
+            col.label(", ".join("{} {:.1f} s".format(stage, seconds)
+                                for stage, seconds in totals.items()))
+        for name, item in slowest_items(proxy_report):
+            col.label("{}: {:.1f} s, {:.0f} MB".format(
+                name, sum(item['stages'].values()), item['peak_memory'] / (1 << 20)))
+
 def register():
     bpy.types.Scene.proxy_width_threshold = bpy.props.IntProperty(name='Width threshold', description='Resize images if wider than this', min=1, soft_max=4096, default = 1024)
-    bpy.types.Scene.proxy_destination = bpy.props.IntProperty(name='Destination width', description='Resize images to this width', min=1, soft_max=4096, default = 1024)
+    bpy.types.Scene.proxy_destination = bpy.props.IntProperty(name='Destination width', description='Resize images to this width', min=1, soft_max=4096, default = 1024, update=update_proxy_level)
+    bpy.types.Scene.proxy_levels = bpy.props.StringProperty(name='Levels', description='Comma-separated widths also generated when proxifying, to switch between them instantly', default='512,1024,2048')
+    bpy.types.Scene.proxy_format = bpy.props.EnumProperty(name='Format', description='File format of the proxies', items=[
+        ('AUTO', 'Automatic', 'JPEG for color images, PNG for images with alpha, 8 bit data maps and PNG images over the streaming threshold, half float EXR for float images and deeper data maps'),
+        ('SOURCE', 'Same as source', 'Same file format as the original image'),
+        ('JPEG', 'JPEG', '8 bit JPEG, without alpha'),
+        ('PNG', 'PNG', '8 bit PNG'),
+        ('OPEN_EXR', 'OpenEXR', 'Half float, ZIP compressed OpenEXR'),
+        ], default='AUTO')
     bpy.types.Scene.proxy_only_selected = bpy.props.BoolProperty(name='Only selected objects', description='Resize textures only on selected objects', default=False)
+    bpy.types.Scene.proxy_workers = bpy.props.IntProperty(name='Processes', description='Number of processes resizing images in parallel (0 for all cores)', min=0, soft_max=64, default=0)
+    bpy.types.Scene.proxy_stream_threshold = bpy.props.IntProperty(name='Streaming threshold (MP)', description='Resize PNG images of at least this many megapixels in strips, to limit memory use (0 to disable)', min=0, default=256)
+    bpy.types.Scene.proxy_memory_budget = bpy.props.IntProperty(name='Memory budget (MB)', description='Memory the images of the scene should fit in, when proxified to the budget', min=1, default=4096)
+    bpy.types.Scene.proxy_report_file = bpy.props.StringProperty(name='Report log', description='Append the timings of each proxify and deproxify run to this file, as a line of JSON', subtype='FILE_PATH')
+    bpy.types.Scene.proxy_cache_size = bpy.props.IntProperty(name='Cache size (MB)', description='Remove least recently used proxies when a proxy folder gets bigger than this (0 for no limit)', min=0, default=4096)
+    bpy.app.handlers.load_post.append(invalidate_proxy_registry)
+    bpy.app.handlers.undo_post.append(invalidate_proxy_registry)
+    bpy.app.handlers.redo_post.append(invalidate_proxy_registry)
     bpy.utils.register_class(ImageProxify)
     bpy.utils.register_class(ImageDeProxify)
+    bpy.utils.register_class(ImageProxyBudget)
     bpy.utils.register_class(ImageProxyPanel)
 
 def unregister():
+    bpy.app.handlers.load_post.remove(invalidate_proxy_registry)
+    bpy.app.handlers.undo_post.remove(invalidate_proxy_registry)
+    bpy.app.handlers.redo_post.remove(invalidate_proxy_registry)
     bpy.utils.unregister_class(ImageProxify)
     bpy.utils.unregister_class(ImageDeProxify)
+    bpy.utils.unregister_class(ImageProxyBudget)
     bpy.utils.unregister_class(ImageProxyPanel)
     del bpy.types.Scene.proxy_width_threshold
     del bpy.types.Scene.proxy_destination
+    del bpy.types.Scene.proxy_levels
+    del bpy.types.Scene.proxy_format
     del bpy.types.Scene.proxy_only_selected
+    del bpy.types.Scene.proxy_workers
+    del bpy.types.Scene.proxy_cache_size
+    del bpy.types.Scene.proxy_stream_threshold
+    del bpy.types.Scene.proxy_report_file
+    del bpy.types.Scene.proxy_memory_budget
+
+
+def main(argv):
+    """Command line entry point, run with:
+
+    blender --background --python proxify.py -- generate --levels 512,1024 image.png ...
+    """
+    parser = argparse.ArgumentParser(prog="proxify.py")
+    subparsers = parser.add_subparsers(dest='command')
+    generate = subparsers.add_parser('generate', help="Generate proxy files for images")
+    generate.add_argument('images', nargs='+')
+    generate.add_argument('--levels', default='512,1024,2048',
+                          help="Comma-separated proxy widths")
+    generate.add_argument('--workers', type=int, default=0)
+    generate.add_argument('--format', default='SOURCE',
+                          choices=['SOURCE'] + sorted(PROXY_FORMAT_EXTENSIONS))
+    generate.add_argument('--stream-threshold', type=int, default=256)
+    worker = subparsers.add_parser('worker')
+    worker.add_argument('job_file')
+    worker.add_argument('--stream-threshold', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        widths = [int(level) for level in args.levels.split(',')]
+        jobs = []
+        for image in args.images:
+            source = os.path.abspath(image)
+            extension = PROXY_FORMAT_EXTENSIONS.get(args.format)
+            jobs.append((source, [(proxy_filepath(source, width, extension), width)
+                                  for width in widths]))
+        failed = generate_proxies(jobs, args.workers, args.stream_threshold)
+        for destination in sorted(failed):
+            print("Proxy: failed: {}".format(destination))
+        sys.exit(1 if failed else 0)
+    elif args.command == 'worker':
+        generate_proxies_worker(args.job_file, args.stream_threshold)
+    else:
+        parser.print_help()
+
 
 if __name__ == "__main__":
-    register()
+    if "--" in sys.argv:
+        main(sys.argv[sys.argv.index("--") + 1:])
+    else:
+        register()
@@ -0,0 +1,112 @@
+# Copyright (C) 2017 Les Fees Speciales
+# voeu@les-fees-speciales.coop
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Stage timings shared by the Proxy Images and Material Tuning add-ons.
+
+This is not an add-on: install it next to them.
+"""
+
+import os
+import json
+import time
+import collections
+import contextlib
+
+
+class StageReport:
+    """Time spent in each stage of an operation, per item.
+
+    Each item also counts the bytes read and written for it, and the peak
+    memory of the image buffers it needed. Items are images, source files
+    or baked textures.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.started = time.time()
+        self.seconds = 0.0
+        self.items = collections.OrderedDict()
+
+    def item(self, key):
+        if key not in self.items:
+            self.items[key] = {"stages": {}, "bytes_read": 0,
+                               "bytes_written": 0, "peak_memory": 0}
+        return self.items[key]
+
+    def add(self, key, stage=None, seconds=0.0, bytes_read=0, bytes_written=0,
+            memory=0):
+        item = self.item(key)
+        if stage is not None:
+            item["stages"][stage] = item["stages"].get(stage, 0.0) + seconds
+        item["bytes_read"] += bytes_read
+        item["bytes_written"] += bytes_written
+        item["peak_memory"] = max(item["peak_memory"], memory)
+
+    @contextlib.contextmanager
+    def stage(self, key, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(key, stage, time.perf_counter() - start)
+
+    def merge(self, key, item):
+        """Add an item of another report, for instance from a worker"""
+        for stage, seconds in item["stages"].items():
+            self.add(key, stage, seconds)
+        self.add(key, bytes_read=item["bytes_read"],
+                 bytes_written=item["bytes_written"], memory=item["peak_memory"])
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+
+    def as_dict(self):
+        return {
+            "operation": self.operation,
+            "started": self.started,
+            "seconds": self.seconds,
+            "items": self.items,
+        }
+
+
+def stage_totals(report):
+    """Return the total seconds of each stage of a report dict"""
+    totals = collections.OrderedDict()
+    for item in report["items"].values():
+        for stage, seconds in item["stages"].items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+    return totals
+
+
+def slowest_items(report, count=5):
+    """Return the (key, item) pairs of a report dict taking the most time"""
+    return sorted(report["items"].items(),
+                  key=lambda i: -sum(i[1]["stages"].values()))[:count]
+
+
+def write_report(report, path):
+    """Append a report dict to a log file, as a line of JSON"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(report, sort_keys=True) + "\n")
+
+
+def image_memory(width, height, is_float=False):
+    """Return the bytes taken by a decoded RGBA image buffer"""
+    return width * height * 4 * (4 if is_float else 1)